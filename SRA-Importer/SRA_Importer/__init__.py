@@ -1,2 +1,25 @@
-from .export_data import export
-from .create_visualization import visualization
+import importlib
+
+# the entry points are imported on first use, so importing the package does not load numpy, scipy or tqdm
+_ENTRY_POINTS = {
+    "export": ".export_data",
+    "visualization": ".create_visualization",
+    "export_sweep": ".sweep",
+    "quality_profile": ".quality",
+    "run_batch": ".batch",
+    "merge_runs": ".merge",
+    "probe_toolchain": ".toolchain",
+}
+__all__ = list(_ENTRY_POINTS)
+
+
+def __getattr__(name):
+    if name not in _ENTRY_POINTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_ENTRY_POINTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
\ No newline at end of file
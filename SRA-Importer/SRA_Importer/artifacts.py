@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import csv
+import io
+import shutil
+import zipfile
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from scipy import sparse
+
+
+@contextmanager
+def open_member(qza_path: str, filename: str):
+    """
+    open <uuid>/data/<filename> of a .qza (or .qzv) archive for reading in binary mode, without extracting it
+    """
+    with zipfile.ZipFile(qza_path) as archive:
+        names = [n for n in archive.namelist() if n.split("/")[1:] == ["data", filename]]
+        if not names:
+            raise FileNotFoundError(f"{filename} was not found in {qza_path}.")
+        with archive.open(names[0]) as member:
+            yield member
+
+
+def artifact_uuid(qza_path: str):
+    """
+    the uuid of an artifact, which is the name of its root directory and changes whenever its data does
+    """
+    with zipfile.ZipFile(qza_path) as archive:
+        return archive.namelist()[0].split("/")[0]
+
+
+def data_size(qza_path: str):
+    """
+    the uncompressed size in bytes of the data files of an artifact
+    """
+    with zipfile.ZipFile(qza_path) as archive:
+        return sum(i.file_size for i in archive.infolist() if i.filename.split("/")[1:2] == ["data"])
+
+
+def _decode(ids):
+    return [i.decode() if isinstance(i, bytes) else str(i) for i in ids]
+
+
+def load_biom(biom_file):
+    """
+    read a BIOM 2.1 HDF5 table from a path or a binary file object.
+    return the CSR matrix of features by samples, the feature ids and the sample ids.
+    """
+    import h5py
+    from scipy import sparse
+    with h5py.File(biom_file, "r") as f:
+        matrix = f["observation/matrix"]
+        feature_ids, sample_ids = _decode(f["observation/ids"][:]), _decode(f["sample/ids"][:])
+        table = sparse.csr_matrix((matrix["data"][:], matrix["indices"][:], matrix["indptr"][:]),
+                                  shape=(len(feature_ids), len(sample_ids)))
+    return table, feature_ids, sample_ids
+
+
+def read_feature_table(qza_path: str):
+    """
+    read the feature table of a FeatureTable[Frequency] artifact.
+    return the CSR matrix of features by samples, the feature ids and the sample ids.
+    """
+    with open_member(qza_path, "feature-table.biom") as member:
+        # h5py needs random access, which is much faster in memory than on a compressed zip member
+        return load_biom(io.BytesIO(member.read()))
+
+
+def read_taxonomy(qza_path: str):
+    """
+    read the taxonomy of a FeatureData[Taxonomy] artifact as a pandas DataFrame indexed by the feature id
+    """
+    import pandas as pd
+    with open_member(qza_path, "taxonomy.tsv") as member:
+        return pd.read_csv(member, sep="\t", index_col=0, comment=None, dtype=str)
+
+
+def read_sequences(qza_path: str):
+    """
+    return a dict of feature id to sequence of a FeatureData[Sequence] artifact
+    """
+    sequences, feature_id = {}, None
+    with open_member(qza_path, "dna-sequences.fasta") as member:
+        for line in io.TextIOWrapper(member, encoding="utf-8"):
+            line = line.strip()
+            if line.startswith(">"):
+                feature_id = line[1:].split()[0]
+                sequences[feature_id] = []
+            elif feature_id is not None:
+                sequences[feature_id].append(line)
+    return {k: "".join(v) for k, v in sequences.items()}
+
+
+def read_tsv_rows(qza_path: str, filename: str):
+    """
+    return the rows of a TSV inside an artifact as dicts, without the '#q2:types' row
+    """
+    with open_member(qza_path, filename) as member:
+        reader = csv.DictReader(io.TextIOWrapper(member, encoding="utf-8"), delimiter="\t")
+        return [row for row in reader if not next(iter(row.values()), "").startswith("#")]
+
+
+def write_table_tsv(path: str, matrix: sparse.csr_matrix, feature_ids: list[str], sample_ids: list[str]):
+    """
+    write a table in the 'biom convert --to-tsv' format, one feature row at a time
+    """
+    import numpy as np
+    with open(path, "w") as f:
+        f.write("# Constructed from biom file\n")
+        f.write("#OTU ID\t" + "\t".join(sample_ids) + "\n")
+        for row, feature_id in enumerate(feature_ids):
+            counts = np.zeros(matrix.shape[1])
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            counts[matrix.indices[start:end]] = matrix.data[start:end]
+            f.write(feature_id + "\t" + "\t".join(map(str, counts)) + "\n")
+
+
+def export_table_tsv(qza_path: str, output_file: str):
+    write_table_tsv(output_file, *read_feature_table(qza_path))
+
+
+def export_member(qza_path: str, filename: str, output_file: str):
+    """
+    stream a file out of an artifact straight to `output_file`
+    """
+    with open_member(qza_path, filename) as member, open(output_file, "wb") as out:
+        shutil.copyfileobj(member, out)
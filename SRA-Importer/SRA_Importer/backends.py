@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import contextvars
+from collections import OrderedDict
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from multiprocessing.connection import Connection
+from types import SimpleNamespace
+
+from .instrumentation import record_command
+from .utilities import run_cmd
+
+LOADED_ARTIFACTS = 16
+WORKER_COMMAND = ("from multiprocessing.connection import Connection; "
+                  "from SRA_Importer.backends import _worker_main; _worker_main(Connection({}))")
+
+_backend = contextvars.ContextVar("sra_importer_backend", default=None)
+
+
+def _cli_option(kind: str, name: str, value):
+    option = f"--{kind}-{name.replace('_', '-')}"
+    if isinstance(value, bool):
+        return [option if value else f"--{kind}-no-{name.replace('_', '-')}"]
+    if isinstance(value, (list, tuple)):
+        return [option] + [str(v) for v in value]
+    return [option, str(value)]
+
+
+def _command(plugin: str, action: str, inputs: dict, params: dict, outputs: dict):
+    command = ["qiime", plugin, action]
+    for kind, values in (("i", inputs), ("p", params), ("o", outputs)):
+        for name, value in values.items():
+            command += _cli_option(kind, name, value)
+    return command
+
+
+class CliBackend:
+    """
+    runs every action as its own 'qiime' command
+    """
+
+    def run_action(self, plugin: str, action: str, inputs: dict, params: dict, outputs: dict):
+        run_cmd(_command(plugin, action, inputs, params, outputs), check=True)
+
+    def import_data(self, semantic_type: str, input_path: str, input_format: str, output_path: str):
+        run_cmd(["qiime", "tools", "import",
+                 "--type", semantic_type,
+                 "--input-path", input_path,
+                 "--input-format", input_format,
+                 "--output-path", output_path], check=True)
+
+    def close(self):
+        pass
+
+
+def _worker_main(conn):
+    """
+    the loop of a worker process. the qiime2 plugins are imported once, and every artifact the worker loads or saves
+    (e.g. the demultiplexed reads) is kept in memory for the next actions which use it.
+    qiime2 builds the view of an input on every action, so classify-sklearn is called with a classifier pipeline
+    the worker viewed once, instead of unpickling it from the artifact for every batch.
+    """
+    import resource
+    try:
+        import qiime2
+        from qiime2.sdk import PluginManager
+        plugins = PluginManager().plugins
+    except Exception as e:
+        conn.send(("unavailable", str(e)))
+        return
+    conn.send(("ready", None))
+
+    # the last LOADED_ARTIFACTS artifacts used, by path, with the views made of them.
+    # an artifact rewritten on disk is loaded again
+    artifacts = OrderedDict()
+
+    def keep(path: str, artifact):
+        artifacts[path] = (os.stat(path).st_mtime_ns, artifact, {})
+        artifacts.move_to_end(path)
+        while len(artifacts) > LOADED_ARTIFACTS:
+            artifacts.popitem(last=False)
+
+    def load(path: str):
+        if path in artifacts and artifacts[path][0] == os.stat(path).st_mtime_ns:
+            artifacts.move_to_end(path)
+        else:
+            keep(path, qiime2.Artifact.load(path))
+        return artifacts[path][1]
+
+    def view(path: str, view_type):
+        artifact, views = load(path), artifacts[path][2]
+        if view_type not in views:
+            views[view_type] = artifact.view(view_type)
+        return views[view_type]
+
+    def save(result, path: str):
+        keep(result.save(path), result)
+
+    def classify_sklearn(inputs: dict, params: dict, outputs: dict):
+        from q2_feature_classifier.classifier import classify_sklearn as classify
+        from q2_types.feature_data import DNAFASTAFormat
+        from sklearn.pipeline import Pipeline
+        taxonomy = classify(reads=load(inputs["reads"]).view(DNAFASTAFormat),
+                            classifier=view(inputs["classifier"], Pipeline), **params)
+        save(qiime2.Artifact.import_data("FeatureData[Taxonomy]", taxonomy), outputs["classification"])
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+        kind, payload = message
+        start, usage = time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            if kind == "action":
+                plugin, action, inputs, params, outputs = payload
+                if (plugin, action) == ("feature-classifier", "classify-sklearn"):
+                    classify_sklearn(inputs, params, outputs)
+                else:
+                    method = plugins[plugin].actions[action.replace("-", "_")]
+                    results = method(**{k: load(v) for k, v in inputs.items()}, **params)
+                    for name, path in outputs.items():
+                        save(getattr(results, name), path)
+            else:
+                semantic_type, input_path, input_format, output_path = payload
+                save(qiime2.Artifact.import_data(semantic_type, input_path, view_type=input_format), output_path)
+            status, error = 0, ""
+        except Exception:
+            status, error = 1, traceback.format_exc()
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        conn.send((status, error, time.perf_counter() - start,
+                   end_usage.ru_utime - usage.ru_utime, end_usage.ru_stime - usage.ru_stime, end_usage.ru_maxrss))
+
+
+class ArtifactApiBackend:
+    """
+    runs actions through the qiime2 Artifact API in `workers` long-lived worker processes,
+    so the plugins are imported once and loaded artifacts are reused between stages.
+    an action goes to the idle worker holding most of its artifacts.
+    falls back to the CLI if qiime2 cannot be imported by the workers. a worker which dies during an action
+    (e.g. killed when out of memory) is replaced, and that action is run again with the CLI.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = max(1, workers)
+        self._idle = []
+        # the paths each worker used last, as it keeps them loaded
+        self._held = {}
+        self._available = threading.Condition()
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._fallback = None
+
+    @staticmethod
+    def _start_worker():
+        # the worker is a fresh interpreter, so unlike a forked process it does not inherit the threads of this one,
+        # and unlike a spawned process it does not import the __main__ module of the caller again
+        parent_sock, child_sock = socket.socketpair()
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(p for p in sys.path if p)}
+        process = subprocess.Popen([sys.executable, "-c", WORKER_COMMAND.format(child_sock.fileno())],
+                                   pass_fds=[child_sock.fileno()], env=env)
+        child_sock.close()
+        conn = Connection(parent_sock.detach())
+        try:
+            state, error = conn.recv()
+        except EOFError:
+            state, error = "unavailable", f"the worker exited with {process.wait()}"
+        if state != "ready":
+            conn.close()
+            process.wait()
+        return process, conn, state, error
+
+    def _start_workers(self):
+        with self._lock:
+            if self._processes or self._fallback is not None:
+                return
+            for _ in range(self.workers):
+                process, conn, state, error = self._start_worker()
+                if state != "ready":
+                    print(f"WARNING: qiime2 could not be imported by the worker, using the qiime CLI instead.\n{error}")
+                    self.close()
+                    self._fallback = CliBackend()
+                    return
+                self._add(process, conn)
+
+    def _add(self, process, conn):
+        with self._available:
+            self._processes[conn] = process
+            self._held[conn] = OrderedDict()
+        self._release(conn, [])
+
+    def _replace(self, conn):
+        with self._available:
+            process = self._processes.pop(conn)
+            del self._held[conn]
+            # callers waiting for a worker give up once none is left
+            self._available.notify_all()
+        conn.close()
+        print(f"WARNING: The qiime2 worker exited with {process.wait()}, starting a new one.")
+        process, conn, state, error = self._start_worker()
+        if state == "ready":
+            self._add(process, conn)
+        else:
+            print(f"WARNING: The qiime2 worker could not be started again.\n{error}")
+
+    def _acquire(self, paths: list):
+        with self._available:
+            while not self._idle and self._processes:
+                self._available.wait()
+            if not self._idle:
+                return None
+            conn = max(self._idle, key=lambda c: sum(path in self._held[c] for path in paths))
+            self._idle.remove(conn)
+            return conn
+
+    def _release(self, conn, paths: list):
+        with self._available:
+            held = self._held[conn]
+            for path in paths:
+                held[path] = None
+                held.move_to_end(path)
+            while len(held) > LOADED_ARTIFACTS:
+                held.popitem(last=False)
+            self._idle.append(conn)
+            self._available.notify()
+
+    def _call(self, command: list, kind: str, payload: tuple, paths: list):
+        """
+        run a call in a worker. return False if no worker could run it, so the caller runs it with the CLI
+        """
+        conn = self._acquire(paths)
+        if conn is None:
+            return False
+        try:
+            conn.send((kind, payload))
+            status, error, wall_time, utime, stime, maxrss = conn.recv()
+        except (EOFError, OSError):
+            self._replace(conn)
+            print(f"WARNING: '{' '.join(command)}' did not finish in the qiime2 worker, running it with the CLI.")
+            return False
+        except BaseException:
+            self._release(conn, paths)
+            raise
+        self._release(conn, paths)
+        record_command(command, status, wall_time,
+                       SimpleNamespace(ru_utime=utime, ru_stime=stime, ru_maxrss=maxrss, ru_oublock=None), error)
+        if status != 0:
+            raise RuntimeError(f"'{' '.join(command)}' failed in the qiime2 worker.\n{error}")
+        return True
+
+    def run_action(self, plugin: str, action: str, inputs: dict, params: dict, outputs: dict):
+        self._start_workers()
+        if self._fallback is None and self._call(_command(plugin, action, inputs, params, outputs), "action",
+                                                 (plugin, action, inputs, params, outputs),
+                                                 list(inputs.values()) + list(outputs.values())):
+            return
+        (self._fallback or CliBackend()).run_action(plugin, action, inputs, params, outputs)
+
+    def import_data(self, semantic_type: str, input_path: str, input_format: str, output_path: str):
+        self._start_workers()
+        if self._fallback is None and self._call(
+                ["qiime", "tools", "import", "--type", semantic_type, "--input-path", input_path],
+                "import", (semantic_type, input_path, input_format, output_path), [output_path]):
+            return
+        (self._fallback or CliBackend()).import_data(semantic_type, input_path, input_format, output_path)
+
+    def close(self):
+        with self._available:
+            conns, processes = self._idle, list(self._processes.values())
+            self._idle, self._held, self._processes = [], {}, {}
+        for conn in conns:
+            # a worker which already died does not stop the others from being closed
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for process in processes:
+            process.wait()
+
+
+def make_backend(backend: str, workers: int = 1):
+    if backend == "cli":
+        return CliBackend()
+    if backend == "api":
+        return ArtifactApiBackend(workers)
+    raise ValueError(f"backend must be 'cli' or 'api'. Got '{backend}'.")
+
+
+@contextmanager
+def use_backend(backend: str | CliBackend | ArtifactApiBackend = "cli", workers: int = 1):
+    """
+    make `backend` the backend of the stages run inside the block.
+    a backend given by name is created for the block and closed at its end, a backend object is left open for reuse.
+    """
+    owned = isinstance(backend, str)
+    backend = make_backend(backend, workers) if owned else backend
+    token = _backend.set(backend)
+    try:
+        yield backend
+    finally:
+        _backend.reset(token)
+        if owned:
+            backend.close()
+
+
+def run_qiime(plugin: str, action: str, inputs: dict | None = None, params: dict | None = None,
+              outputs: dict | None = None):
+    """
+    run a qiime2 action with the active backend. names are given as in the Python API (e.g. 'demultiplexed_seqs'),
+    and are converted to options (e.g. '--i-demultiplexed-seqs') by the CLI backend.
+    """
+    (_backend.get() or CliBackend()).run_action(plugin, action, inputs or {}, params or {}, outputs or {})
+
+
+def import_data(semantic_type: str, input_path: str, input_format: str, output_path: str):
+    (_backend.get() or CliBackend()).import_data(semantic_type, input_path, input_format, output_path)
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import csv
+import heapq
+import io
+import itertools
+import os
+import shutil
+import threading
+import urllib.request
+from dataclasses import dataclass, field
+
+from .backends import make_backend, CliBackend, ArtifactApiBackend
+from .create_visualization import visualization, read_accessions
+from .export_data import export
+from .instrumentation import progress, timestamp
+from .utilities import check_conda_qiime2, make_run_dir
+
+RUNINFO_URL = "https://trace.ncbi.nlm.nih.gov/Traces/sra-db-be/runinfo?acc={}"
+# the last visualization() stage of each batch task, None for the whole visualization()
+VISUALIZATION_UNTIL = {"download": "download_data_from_sra", "convert": "sra_to_fastq", "import": None}
+REPORT_FIELDS = ["name", "priority", "status", "stage", "run_dir", "accessions", "started", "finished", "error"]
+
+
+@dataclass
+class Project:
+    """
+    a single accession list, given as a local `acc_list` file or as a `bioproject` accession resolved to its runs.
+    projects with a lower `priority` are scheduled first. `threads` is the CPU share of each of its stages,
+    `export_kwargs` are passed to export() (no export is made without them),
+    and `visualization_kwargs` are passed to visualization().
+    """
+    name: str
+    acc_list: str | None = None
+    bioproject: str | None = None
+    priority: int = 0
+    threads: int = 4
+    export_kwargs: dict | None = None
+    visualization_kwargs: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if (self.acc_list is None) == (self.bioproject is None):
+            raise ValueError(f"Project '{self.name}' must have exactly one of acc_list and bioproject.")
+
+
+def resolve_bioproject(bioproject: str, acc_list: str):
+    """
+    write the runs of a BioProject to `acc_list` and return their total size in bytes (0 if unknown)
+    """
+    with urllib.request.urlopen(RUNINFO_URL.format(bioproject)) as response:
+        rows = list(csv.DictReader(io.StringIO(response.read().decode("utf-8"))))
+    runs = [row for row in rows if row.get("Run")]
+    if not runs:
+        raise ValueError(f"No runs were found for {bioproject}.")
+    with open(acc_list, "w") as f:
+        f.write("\n".join(row["Run"] for row in runs) + "\n")
+    return sum(int(float(row.get("size_MB") or 0) * 2 ** 20) for row in runs)
+
+
+@dataclass(order=True)
+class _Task:
+    priority: int
+    seq: int
+    project: Project = field(compare=False)
+    stage: str = field(compare=False)
+    threads: int = field(compare=False)
+
+
+class BatchRunner:
+    """
+    runs the stages of many projects on one machine within a shared budget of `threads` and `disk` bytes.
+    every project is scheduled as a download, a conversion, an import and an optional export task
+    (with pipeline=True the download is part of the conversion). ready tasks wait in a priority queue, and the first
+    task (by priority, then submission order) which fits in the free budget is started. downloads are network bound,
+    so they take no threads and at most `downloads` of them run at once. a project reserves its estimated disk from
+    its first task until it is done, since its run directory stays on disk.
+    """
+
+    def __init__(self, projects: list[Project], batch_dir: str, threads: int, disk: int | None = None,
+                 disk_per_accession: int = 2 * 2 ** 30, downloads: int = 2,
+                 backend: str | CliBackend | ArtifactApiBackend = "cli"):
+        self.projects = projects
+        self.batch_dir = os.path.abspath(batch_dir)
+        self.threads = threads
+        self.downloads = downloads
+        self.disk = disk if disk is not None else shutil.disk_usage(self.batch_dir).free
+        self.disk_per_accession = disk_per_accession
+        self.report_path = os.path.join(self.batch_dir, "batch_report.tsv")
+        # a single backend serves all the projects, so an api backend loads e.g. the classifier once per worker
+        self.backend = backend
+
+        self._free_threads, self._free_disk, self._free_downloads = threads, self.disk, downloads
+        self._queue: list[_Task] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._disk: dict[str, int] = {}
+        self._reserved: set[str] = set()
+        self._cond = threading.Condition()
+        self.status = {p.name: {"name": p.name, "priority": p.priority, "status": "pending", "stage": "",
+                                "run_dir": "", "accessions": "", "started": "", "finished": "", "error": ""}
+                       for p in projects}
+
+    @staticmethod
+    def _stages(project: Project):
+        stages = ["convert", "import"] if project.visualization_kwargs.get("pipeline") else \
+            ["download", "convert", "import"]
+        return stages + (["export"] if project.export_kwargs is not None else [])
+
+    def _push(self, project: Project, stage: str):
+        threads = 0 if stage == "download" else min(project.threads, self.threads)
+        heapq.heappush(self._queue, _Task(project.priority, next(self._seq), project, stage, threads))
+
+    def _pop_fitting(self):
+        """
+        pop the first task which fits in the free budget, or None if no task fits
+        """
+        skipped, fitting = [], None
+        while self._queue:
+            task = heapq.heappop(self._queue)
+            disk = self._disk[task.project.name] if task.project.name not in self._reserved else 0
+            downloads = int(task.stage == "download")
+            if task.threads <= self._free_threads and disk <= self._free_disk and downloads <= self._free_downloads:
+                self._free_threads -= task.threads
+                self._free_disk -= disk
+                self._free_downloads -= downloads
+                self._reserved.add(task.project.name)
+                fitting = task
+                break
+            skipped.append(task)
+        for task in skipped:
+            heapq.heappush(self._queue, task)
+        return fitting
+
+    def _update(self, name: str, **status):
+        with self._cond:
+            self.status[name].update(status)
+            with open(self.report_path, "w", newline="") as f:
+                tsv_writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, delimiter="\t")
+                tsv_writer.writeheader()
+                tsv_writer.writerows(self.status.values())
+
+    def _prepare(self, project: Project):
+        """
+        create the run directory and the accession list of a project, and return its estimated disk use
+        """
+        run_dir = os.path.join(self.batch_dir, project.name)
+        os.makedirs(run_dir, exist_ok=True)
+        if project.bioproject is not None:
+            acc_list = os.path.join(run_dir, "accessions.txt")
+            size = resolve_bioproject(project.bioproject, acc_list)
+        else:
+            acc_list, size = os.path.abspath(project.acc_list), 0
+        accessions = len(read_accessions(acc_list))
+        self._update(project.name, run_dir=run_dir, accessions=accessions)
+        # the .sra, the .fastq and the qiime2 artifacts take a few times the size of the raw data
+        return acc_list, max(3 * size, accessions * self.disk_per_accession)
+
+    def _run_task(self, task: _Task, acc_list: str):
+        project = task.project
+        started = self.status[project.name]["started"] or timestamp()
+        self._update(project.name, status="running", stage=task.stage, started=started)
+        run_dir = self.status[project.name]["run_dir"]
+        stages = self._stages(project)
+        try:
+            if task.stage == "export":
+                export(output_dir=run_dir, threads=task.threads, backend=self.backend, **project.export_kwargs)
+            else:
+                kwargs = {"output_vis_path": "", "jobs": max(1, task.threads // 2), **project.visualization_kwargs}
+                if task.stage != stages[0]:
+                    # the stages of the earlier tasks are done, so they are skipped by resuming
+                    kwargs.update(resume=True, force_from=None)
+                until = VISUALIZATION_UNTIL[task.stage]
+                if until == "sra_to_fastq" and kwargs.get("pipeline"):
+                    until = "download_and_convert"
+                visualization(acc_list=acc_list, output_dir=run_dir, threads=task.threads, backend=self.backend,
+                              until=until, **kwargs)
+        except Exception as e:
+            self._update(project.name, status="failed", error=str(e), finished=timestamp())
+            follow_up = None
+        else:
+            follow_up = stages[stages.index(task.stage) + 1] if task.stage != stages[-1] else None
+            if follow_up is None:
+                self._update(project.name, status="done", stage="", finished=timestamp())
+        with self._cond:
+            self._free_threads += task.threads
+            self._free_downloads += int(task.stage == "download")
+            if follow_up is None:
+                self._free_disk += self._disk[project.name]
+            else:
+                self._push(project, follow_up)
+            self._running -= 1
+            self._cond.notify_all()
+
+    def run(self):
+        acc_lists = {}
+        for project in self.projects:
+            try:
+                acc_lists[project.name], disk = self._prepare(project)
+            except Exception as e:
+                self._update(project.name, status="failed", error=str(e), finished=timestamp())
+                continue
+            # a project larger than the whole budget runs alone
+            self._disk[project.name] = min(disk, self.disk)
+            self._push(project, self._stages(project)[0])
+
+        with self._cond:
+            while self._queue or self._running:
+                task = self._pop_fitting()
+                if task is None:
+                    self._cond.wait()
+                    continue
+                self._running += 1
+                progress(f"Batch: start {task.stage} of {task.project.name}")
+                threading.Thread(target=self._run_task, args=(task, acc_lists[task.project.name]),
+                                 daemon=True).start()
+        return list(self.status.values())
+
+
+def run_batch(*, projects: list[Project | dict], output_dir: str = ".", threads: int = 12,
+              disk_gb: float | None = None, disk_per_accession_gb: float = 2, downloads: int = 2,
+              backend: str = "cli", backend_workers: int = 2):
+    """
+    run visualization() and export() for many projects, within a shared budget of `threads` and `disk_gb`
+    (default is the free space of `output_dir`), with at most `downloads` projects downloading at once. every project gets its own run directory under
+    <output_dir>/SRA-Importer-batch-..., next to batch_report.tsv which is kept up to date with the status of each project.
+    with backend="api", the stages of all the projects run in `backend_workers` shared qiime2 worker processes.
+    return the final status rows.
+    """
+    check_conda_qiime2()
+    projects = [p if isinstance(p, Project) else Project(**p) for p in projects]
+    if len({p.name for p in projects}) != len(projects):
+        raise ValueError("Project names must be unique.")
+
+    batch_dir = make_run_dir(output_dir, prefix="SRA-Importer-batch")
+    runner = BatchRunner(projects, batch_dir, threads=threads,
+                         disk=int(disk_gb * 2 ** 30) if disk_gb is not None else None,
+                         disk_per_accession=int(disk_per_accession_gb * 2 ** 30), downloads=downloads,
+                         backend=make_backend(backend, workers=backend_workers))
+    try:
+        report = runner.run()
+    finally:
+        runner.backend.close()
+    progress(f"Batch finished, the report is located in {runner.report_path}")
+    return report
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+import uuid
+
+from .instrumentation import path_size
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SRA-Importer", "artifacts")
+
+
+def _link_or_copy(src: str, dst: str):
+    # hard links cost no space, copying is the fallback across file systems
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _read_only(path: str):
+    # a linked entry shares its inode with the runs, so a tool writing a run's output in place fails loudly
+    # instead of silently changing the cache entry and every other run linked to it
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+class ArtifactCache:
+    """
+    on-disk cache of stage outputs, keyed by the stage name, its parameters and the digests of its inputs.
+    every entry is a directory named by its key; its modification time is its last use,
+    and the least recently used entries are evicted once the cache is larger than `max_size` bytes.
+    the cached files are read-only, since they are hard linked into the runs.
+    """
+
+    def __init__(self, cache_dir: str | None = None, max_size: int = 50 * 2 ** 30):
+        self.cache_dir = os.path.abspath(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage_name: str, params: dict, input_digests: list):
+        payload = json.dumps({"stage": stage_name, "params": params, "inputs": input_digests}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def fetch(self, key: str, outputs: list):
+        """
+        place the cached outputs of `key` in the given paths. return True on a cache hit, False O/W
+        """
+        entry = os.path.join(self.cache_dir, key)
+        cached = [os.path.join(entry, os.path.basename(p)) for p in outputs]
+        if not all(os.path.isfile(p) for p in cached):
+            return False
+        for src, dst in zip(cached, outputs):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.exists(dst):
+                os.remove(dst)
+            _link_or_copy(src, dst)
+        os.utime(entry)
+        return True
+
+    def store(self, key: str, outputs: list, description: dict | None = None):
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+        tmp_entry = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_entry)
+        for path in outputs:
+            cached = os.path.join(tmp_entry, os.path.basename(path))
+            _link_or_copy(path, cached)
+            _read_only(cached)
+        with open(os.path.join(tmp_entry, "entry.json"), "w") as f:
+            json.dump(description or {}, f, indent=2)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another run stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if os.path.isdir(path) and not name.startswith(".tmp-"):
+                    entries.append((os.path.getmtime(path), path_size(path), path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
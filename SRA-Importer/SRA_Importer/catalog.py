@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import csv
+import os
+import re
+from dataclasses import dataclass
+
+# <accession>.fastq for single-end reads, <accession>_1.fastq and <accession>_2.fastq for paired reads,
+# as written by 'fasterq-dump --split-files', optionally gzipped. runs with technical or index reads also get
+# <accession>_3.fastq and on, which are matched so they are not taken for samples, and ignored
+FASTQ_PATTERN = re.compile(r"^(?P<sample>.+?)(?:_(?P<read>[1-9]))?\.f(?:ast)?q(?:\.gz)?$")
+
+
+@dataclass
+class SampleFiles:
+    """
+    the fastq files of a single sample: `fwd` and `rev` are its _1 and _2 files, `single` its file without a suffix
+    """
+    name: str
+    fwd: str | None = None
+    rev: str | None = None
+    single: str | None = None
+
+    @property
+    def paired(self):
+        return self.fwd is not None and self.rev is not None
+
+    @property
+    def forward(self):
+        # the reads of the sample in a single-end manifest
+        return self.fwd or self.single
+
+
+def scan_fastq(fastq_dir: str):
+    """
+    index the fastq files of a directory by sample in a single os.scandir pass.
+    return a dict of sample name to SampleFiles, sorted by name.
+    """
+    samples = {}
+    with os.scandir(fastq_dir) as entries:
+        for entry in entries:
+            match = FASTQ_PATTERN.match(entry.name)
+            if match is None or match.group("read") not in {"1", "2", None} or not entry.is_file():
+                continue
+            sample = samples.get(match.group("sample"))
+            if sample is None:
+                sample = samples[match.group("sample")] = SampleFiles(match.group("sample"))
+            read = match.group("read")
+            setattr(sample, {"1": "fwd", "2": "rev", None: "single"}[read], entry.path)
+    return {name: samples[name] for name in sorted(samples)}
+
+
+def is_paired(samples: dict):
+    """
+    True if every sample has both forward and reverse reads.
+    samples of mixed layouts are imported as single-end, from their forward reads.
+    """
+    return bool(samples) and all(sample.paired for sample in samples.values())
+
+
+def files_by_read(samples: dict):
+    """
+    return the forward and the reverse files of the samples, in the layout they are imported with
+    """
+    if is_paired(samples):
+        return [s.fwd for s in samples.values()], [s.rev for s in samples.values()]
+    return [s.forward for s in samples.values() if s.forward is not None], []
+
+
+def _warn_single_end(samples: dict):
+    reverse_only = [name for name, sample in samples.items() if sample.forward is None]
+    if reverse_only:
+        print(f"WARNING: {len(reverse_only)} samples have only reverse reads and are not imported "
+              f"({', '.join(reverse_only[:5])}{', ...' if len(reverse_only) > 5 else ''}).")
+    paired = sum(sample.paired for sample in samples.values())
+    if paired:
+        print(f"WARNING: {paired} of {len(samples)} samples have paired reads and the others are single-end. "
+              f"All the samples are imported as single-end reads, from their forward reads.")
+
+
+def write_manifest(manifest_path: str, samples: dict):
+    """
+    write the qiime2 fastq manifest of the samples in a single pass, and return whether it is paired.
+    samples with only reverse reads cannot be imported and are left out.
+    """
+    paired = is_paired(samples)
+    with open(manifest_path, "w", newline="") as manifest:
+        tsv_writer = csv.writer(manifest, delimiter="\t")
+        if paired:
+            tsv_writer.writerow(["SampleID", "forward-absolute-filepath", "reverse-absolute-filepath"])
+            tsv_writer.writerows([s.name, os.path.abspath(s.fwd), os.path.abspath(s.rev)] for s in samples.values())
+        else:
+            tsv_writer.writerow(["SampleID", "absolute-filepath"])
+            tsv_writer.writerows([s.name, os.path.abspath(s.forward)] for s in samples.values()
+                                 if s.forward is not None)
+    if not paired:
+        _warn_single_end(samples)
+    return paired
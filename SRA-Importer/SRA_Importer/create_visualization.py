@@ -1,12 +1,20 @@
 from __future__ import annotations
 
-import csv
 import os.path
 import pickle
+import shutil
+import dataclasses
 import datetime
-from tqdm import tqdm
+import threading
+from concurrent.futures import as_completed
+from typing import Callable
 
-from .utilities import run_cmd, ReadsData, check_conda_qiime2
+from .backends import run_qiime, import_data, use_backend, CliBackend, ArtifactApiBackend
+from .catalog import scan_fastq, is_paired, write_manifest
+from .instrumentation import ContextThreadPoolExecutor, RunRecorder
+from .stages import Stage, RunState, run_stages
+from .storage import StoragePolicy, storage_policy, gzip_files, remove_path
+from .utilities import run_cmd, ReadsData, check_conda_qiime2, make_run_dir
 
 CONDA_PREFIX = os.environ.get("CONDA_PREFIX", None)
 
@@ -15,6 +23,10 @@ def check_input(acc_list: str, output_vis_path: str):
     if not (os.path.exists(acc_list) and os.path.isfile(acc_list)):
         FileNotFoundError("The given acc_list does not exist or is not a file.")
 
+    # an empty output_vis_path means the default location
+    if output_vis_path == "":
+        return
+
     t = os.path.join(*os.path.split(output_vis_path)[:-1])
     if not (os.path.exists(t) and os.path.isdir(t)):
         print("WARNING: Invalid output_vis_path. output_vis_path must be located in an existing directory."
@@ -27,119 +39,291 @@ def check_input(acc_list: str, output_vis_path: str):
 
 def download_data_from_sra(dir_path: str, acc_list: str = ""):
     """
-    return True if downloaded the data successfully, False O/W
+    prefetch every accession of `acc_list` to sra/, and report each accession which was not downloaded.
+    raise if none of them was.
     """
     run_cmd(["mkdir", os.path.join(dir_path, "sra")])
-    run_cmd(['prefetch',
-             "--option-file", acc_list,
-             "--output-directory", os.path.join(dir_path, "sra"),
-             "--max-size", "u"])
+    o, e = run_cmd(['prefetch',
+                    "--option-file", acc_list,
+                    "--output-directory", os.path.join(dir_path, "sra"),
+                    "--max-size", "u"])
+    accessions = read_accessions(acc_list)
+    downloaded = set(os.listdir(os.path.join(dir_path, "sra")))
+    missing = [acc for acc in accessions if acc not in downloaded]
+    for acc in missing:
+        print(f"WARNING: Failed downloading {acc}.")
+    if missing and e.strip():
+        print(f"prefetch reported:\n{e.strip()}")
+    if accessions and len(missing) == len(accessions):
+        raise RuntimeError("All the accessions failed to download.")
+
+
+def _fastq_paths(fastq_path: str, acc: str):
+    # the files fasterq-dump writes for an accession (_3 and on are technical reads),
+    # and the files compressing them writes
+    return [os.path.join(fastq_path, f"{acc}{suffix}{extension}")
+            for suffix in [f"_{read}" for read in range(1, 10)] + [""]
+            for extension in (".fastq", ".fastq.gz", ".fastq.gz.tmp")]
+
+
+def convert_accession(dir_path: str, sra_dir: str, threads: int = 1, storage: StoragePolicy | None = None):
+    """
+    convert a single prefetched accession to fastq files.
+    every call gets its own temp directory so concurrent conversions do not collide.
+    the storage policy may then compress the fastq files and delete the .sra.
+    if anything fails, the fastq files of the accession are deleted, so no half-written sample is imported.
+    """
+    sra_files = os.listdir(os.path.join(dir_path, "sra", sra_dir))
+    if not sra_files:
+        raise FileNotFoundError(f"No .sra file was found for {sra_dir}.")
+    sra_path = os.path.join(dir_path, "sra", sra_dir, sra_files[0])
+    fastq_path = os.path.join(dir_path, "fastq")
+    temp_path = os.path.join(dir_path, "tmp", sra_dir)
+    os.makedirs(temp_path, exist_ok=True)
+    storage = storage or StoragePolicy()
+    try:
+        run_cmd(["fasterq-dump", "--split-files", sra_path, "-O", fastq_path,
+                 "--threads", str(threads), "--temp", temp_path], check=True)
+        if storage.compress_fastq:
+            # found by name, without listing the whole directory
+            gzip_files([path for path in _fastq_paths(fastq_path, sra_dir)
+                        if path.endswith(".fastq") and os.path.isfile(path)], threads)
+    except BaseException:
+        for path in _fastq_paths(fastq_path, sra_dir):
+            remove_path(path)
+        raise
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    if storage.delete_sra:
+        remove_path(os.path.join(dir_path, "sra", sra_dir))
+
+
+def _try_convert(dir_path: str, sra_dir: str, threads: int, storage: StoragePolicy | None = None):
+    try:
+        convert_accession(dir_path, sra_dir, threads, storage)
+    except Exception as e:
+        return sra_dir, e
+    return sra_dir, None
+
+
+def report_failures(failures: dict, total: int):
+    """
+    print every failed accession and raise if none of the accessions succeeded
+    """
+    for acc, error in sorted(failures.items()):
+        print(f"WARNING: Failed converting {acc}:\n{error}")
+    if total and len(failures) == total:
+        raise RuntimeError("All the accessions failed to convert to .fastq.")
+
 
+def _progress(total: int):
+    # tqdm is imported by the first conversion rather than with the package
+    from tqdm import tqdm
+    return tqdm(total=total, desc="converted files")
 
-def sra_to_fastq(dir_path: str):
+
+def sra_to_fastq(dir_path: str, jobs: int = 1, threads: int | None = None, storage: StoragePolicy | None = None):
+    """
+    convert every prefetched accession to fastq, running up to `jobs` fasterq-dump processes at once.
+    `threads` is the total thread budget, split evenly between the jobs (default is the number of CPUs).
+    """
     run_cmd(["mkdir", os.path.join(dir_path, "fastq")])
-    for sra_dir in tqdm(os.listdir(os.path.join(dir_path, "sra")), desc="converted files"):
-        sra_file = os.listdir(os.path.join(dir_path, "sra", sra_dir))[0]
-        sra_path = os.path.join(dir_path, "sra", sra_dir, sra_file)
-        fastq_path = os.path.join(dir_path, "fastq")
-        run_cmd(["fasterq-dump", "--split-files", sra_path, "-O", fastq_path])
+    sra_dirs = sorted(os.listdir(os.path.join(dir_path, "sra")))
+    jobs = max(1, min(jobs, len(sra_dirs)))
+    threads_per_job = max(1, (threads or os.cpu_count() or 1) // jobs)
+
+    failures = {}
+    with ContextThreadPoolExecutor(max_workers=jobs) as pool, \
+            _progress(len(sra_dirs)) as progress:
+        futures = [pool.submit(_try_convert, dir_path, sra_dir, threads_per_job, storage) for sra_dir in sra_dirs]
+        for future in as_completed(futures):
+            acc, error = future.result()
+            if error is not None:
+                failures[acc] = error
+            progress.update(1)
+    shutil.rmtree(os.path.join(dir_path, "tmp"), ignore_errors=True)
+    report_failures(failures, len(sra_dirs))
+    return reads_layout(dir_path)
+
+
+def read_accessions(acc_list: str):
+    with open(acc_list) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def prefetch_accession(dir_path: str, acc: str):
+    run_cmd(['prefetch', acc,
+             "--output-directory", os.path.join(dir_path, "sra"),
+             "--max-size", "u"], check=True)
+
 
-    # check if reads include fwd and rev
-    fastqs = sorted(os.listdir(os.path.join(dir_path, "fastq")))[:3]
-    if len(set([fastq.split("_")[0] for fastq in fastqs])) == 1:
-        return ReadsData(dir_path, fwd=True, rev=True)
-    return ReadsData(dir_path, fwd=True, rev=False)
+def download_and_convert(dir_path: str, acc_list: str, jobs: int = 1, threads: int | None = None,
+                         downloads: int = 2, window: int | None = None, storage: StoragePolicy | None = None):
+    """
+    prefetch the accessions one by one and convert each of them as soon as its .sra file lands.
+    at most `window` accessions (default is 2 * jobs) are downloaded or waiting for conversion at once,
+    and the .sra of every converted accession is deleted, which caps the local disk use.
+    """
+    run_cmd(["mkdir", os.path.join(dir_path, "sra")])
+    run_cmd(["mkdir", os.path.join(dir_path, "fastq")])
+    accessions = read_accessions(acc_list)
+    jobs = max(1, jobs)
+    threads_per_job = max(1, (threads or os.cpu_count() or 1) // jobs)
+    slots = threading.Semaphore(max(1, window or 2 * jobs))
+    # the window caps the disk only if a converted .sra does not stay behind
+    storage = dataclasses.replace(storage or StoragePolicy(), delete_sra=True)
+    lock = threading.Lock()
+    failures = {}
+
+    def done(acc: str, error: Exception | None):
+        with lock:
+            if error is not None:
+                failures[acc] = error
+            progress.update(1)
+        slots.release()
+
+    def convert(acc: str):
+        done(*_try_convert(dir_path, acc, threads_per_job, storage))
+
+    def fetch(acc: str):
+        try:
+            prefetch_accession(dir_path, acc)
+        except Exception as e:
+            done(acc, e)
+            return
+        convert_pool.submit(convert, acc)
+
+    # the pools are closed in reverse order: all fetches, then all conversions, then the progress bar
+    with _progress(len(accessions)) as progress, \
+            ContextThreadPoolExecutor(max_workers=jobs) as convert_pool, \
+            ContextThreadPoolExecutor(max_workers=max(1, downloads)) as fetch_pool:
+        for acc in accessions:
+            slots.acquire()
+            fetch_pool.submit(fetch, acc)
+    shutil.rmtree(os.path.join(dir_path, "tmp"), ignore_errors=True)
+    report_failures(failures, len(accessions))
+    return reads_layout(dir_path)
+
+
+def reads_layout(dir_path: str):
+    # the reads are paired only if every sample has both a forward and a reverse file
+    samples = scan_fastq(os.path.join(dir_path, "fastq"))
+    return ReadsData(dir_path, fwd=True, rev=is_paired(samples))
 
 
 def create_manifest(reads_data: ReadsData):
-    fastq_path = os.path.join(reads_data.dir_path, "fastq")
-    if not reads_data.rev:
-        files = [os.path.join(fastq_path, f) for f in os.listdir(fastq_path)
-                 if os.path.isfile(os.path.join(fastq_path, f))]
-        names = [f.split('/')[-1].split('.')[0] for f in files]
-
-        with open(os.path.join(reads_data.dir_path, 'manifest.tsv'), 'w') as manifest:
-            tsv_writer = csv.writer(manifest, delimiter='\t')
-            tsv_writer.writerow(["SampleID", "absolute-filepath"])
-            for n, f in zip(*(names, files)):
-                tsv_writer.writerow([n, f])
-        return
+    """
+    write the manifest from a fresh scan of fastq/, and return the layout it was written with
+    """
+    paired = write_manifest(os.path.join(reads_data.dir_path, "manifest.tsv"),
+                            scan_fastq(os.path.join(reads_data.dir_path, "fastq")))
+    return ReadsData(reads_data.dir_path, fwd=True, rev=paired)
 
-    files_fwd = sorted([os.path.join(fastq_path, f) for f in os.listdir(fastq_path)
-                        if os.path.isfile(os.path.join(fastq_path, f)) and "_1" in f])
-    files_rev = sorted([os.path.join(fastq_path, f) for f in os.listdir(fastq_path)
-                        if os.path.isfile(os.path.join(fastq_path, f)) and "_2" in f])
-    names = sorted([f.split('.')[0] for f in os.path.join(reads_data.dir_path, "sra")])
 
-    with open(os.path.join(reads_data.dir_path, 'manifest.tsv'), 'w') as manifest:
-        tsv_writer = csv.writer(manifest, delimiter='\t')
-        tsv_writer.writerow(["SampleID", "forward-absolute-filepath", "reverse-absolute-filepath"])
-        for n, ff, fr in zip(*(names, files_fwd, files_rev)):
-            tsv_writer.writerow([n, ff, fr])
+def demux_path(reads_data: ReadsData):
+    paired = reads_data.rev and reads_data.fwd
+    return os.path.join(reads_data.dir_path, "qza", f"demux-{'paired' if paired else 'single'}-end.qza")
+
+
+def demux_vis_path(reads_data: ReadsData, output_vis_path: str = ""):
+    if output_vis_path == "":
+        return os.path.join(reads_data.dir_path, "vis", os.path.split(demux_path(reads_data))[-1].split(".")[0] + ".qzv")
+    return output_vis_path
 
 
 def qiime_import(reads_data: ReadsData):
     run_cmd(["mkdir", os.path.join(reads_data.dir_path, "qza")])
-    qza_path = os.path.join(reads_data.dir_path, "qza")
     paired = reads_data.rev and reads_data.fwd
 
-    output_path = os.path.join(qza_path, f"demux-{'paired' if paired else 'single'}-end.qza")
-    command = [
-        "qiime", "tools", "import",
-        "--type", f"SampleData[{'PairedEndSequencesWithQuality' if paired else 'SequencesWithQuality'}]",
-        "--input-path", f"{os.path.join(reads_data.dir_path, 'manifest.tsv')}",
-        "--input-format", "PairedEndFastqManifestPhred33V2" if paired else "SingleEndFastqManifestPhred33V2",
-        "--output-path", output_path
-    ]
-    run_cmd(command)
+    output_path = demux_path(reads_data)
+    import_data(f"SampleData[{'PairedEndSequencesWithQuality' if paired else 'SequencesWithQuality'}]",
+                os.path.join(reads_data.dir_path, "manifest.tsv"),
+                "PairedEndFastqManifestPhred33V2" if paired else "SingleEndFastqManifestPhred33V2",
+                output_path)
     return output_path
 
 
 def qiime_demux(reads_data: ReadsData, input_path: str, output_vis_path: str = ""):
     if output_vis_path == "":
         run_cmd(["mkdir", os.path.join(reads_data.dir_path, "vis")])
-        output_path = os.path.join(reads_data.dir_path, "vis", os.path.split(input_path)[-1].split(".")[0] + ".qzv")
-    else:
-        output_path = output_vis_path
+    output_path = demux_vis_path(reads_data, output_vis_path)
 
-    command = [
-        "qiime", "demux", "summarize",
-        "--i-data", input_path,
-        "--o-visualization", output_path
-    ]
-    run_cmd(command)
+    run_qiime("demux", "summarize", inputs={"data": input_path}, outputs={"visualization": output_path})
     return output_path
 
 
-def visualization(*, acc_list, output_vis_path):
+def visualization(*, acc_list, output_vis_path, jobs: int = 1, threads: int | None = None,
+                  pipeline: bool = False, downloads: int = 2, window: int | None = None,
+                  output_dir: str | None = None, resume: bool = True, force_from: str | None = None,
+                  until: str | None = None, callback: Callable[[dict], None] | None = None,
+                  storage: StoragePolicy | dict | None = None,
+                  backend: str | CliBackend | ArtifactApiBackend = "cli"):
     check_conda_qiime2()
 
-    start_import = datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S')
-    run_cmd(["mkdir", f"SRA-Importer-{start_import}"])
-    dir_path = os.path.join(os.path.abspath("."), f"SRA-Importer-{start_import}")
+    dir_path = make_run_dir() if output_dir is None else os.path.abspath(output_dir)
     check_input(acc_list, output_vis_path)
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start prefetch (1/5)")
-    download_data_from_sra(dir_path, acc_list)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish prefetch (1/5)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start converting .sra to .fastq (2/5)")
-    reads_data = sra_to_fastq(dir_path)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish converting .sra to .fastq (2/5)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start creating manifest (3/5)")
-    create_manifest(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating manifest (3/5)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime import' (4/5)")
-    output_path = qiime_import(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime import' (4/5)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start 'qiime demux' (5/5)")
-    vis_path = qiime_demux(reads_data, output_path, output_vis_path)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish 'qiime demux' (5/5)")
-
-    pickle.dump(reads_data, open(os.path.join(reads_data.dir_path, "reads_data.pkl"), "wb"))
+    storage = storage_policy(storage)
+
+    sra_path = os.path.join(dir_path, "sra")
+    fastq_path = os.path.join(dir_path, "fastq")
+    manifest_path = os.path.join(dir_path, "manifest.tsv")
+    reads_data_path = os.path.join(dir_path, "reads_data.pkl")
+
+    known = {}
+
+    def layout():
+        # the layout is known only after the conversion, and many stages need it. it is saved by the conversion and
+        # the manifest (the storage policy may prune fastq/ later), so fastq/ is scanned here only for older runs
+        if "reads_data" not in known:
+            if os.path.isfile(reads_data_path):
+                with open(reads_data_path, "rb") as f:
+                    known["reads_data"] = pickle.load(f)
+            else:
+                known["reads_data"] = reads_layout(dir_path)
+        return known["reads_data"]
+
+    def converted(reads_data: ReadsData):
+        known["reads_data"] = reads_data
+        pickle.dump(reads_data, open(reads_data_path, "wb"))
+
+    if pipeline:
+        stages = [
+            Stage("download_and_convert", description="prefetch and converting .sra to .fastq",
+                  func=lambda: converted(download_and_convert(dir_path, acc_list, jobs=jobs, threads=threads,
+                                                              downloads=downloads, window=window, storage=storage)),
+                  inputs=[acc_list], outputs=[fastq_path]),
+        ]
+    else:
+        stages = [
+            Stage("download_data_from_sra", description="prefetch",
+                  func=lambda: download_data_from_sra(dir_path, acc_list),
+                  inputs=[acc_list], outputs=[sra_path]),
+            Stage("sra_to_fastq", description="converting .sra to .fastq",
+                  func=lambda: converted(sra_to_fastq(dir_path, jobs=jobs, threads=threads, storage=storage)),
+                  inputs=[sra_path], outputs=[fastq_path], consumes=[sra_path] if storage.delete_sra else []),
+        ]
+    stages += [
+        Stage("create_manifest", description="creating manifest",
+              func=lambda: converted(create_manifest(layout())),
+              inputs=[fastq_path], outputs=[manifest_path]),
+        Stage("qiime_import", description="'qiime import'",
+              func=lambda: qiime_import(layout()),
+              inputs=[manifest_path, fastq_path], outputs=lambda: [demux_path(layout())]),
+        Stage("qiime_demux", description="'qiime demux'",
+              func=lambda: qiime_demux(layout(), demux_path(layout()), output_vis_path),
+              inputs=lambda: [demux_path(layout())],
+              outputs=lambda: [demux_vis_path(layout(), output_vis_path)]),
+    ]
+    with RunRecorder(os.path.join(dir_path, "run_log.jsonl"), callback).activate(), use_backend(backend):
+        run_stages(RunState(dir_path), stages, resume=resume, force_from=force_from, storage=storage,
+                   keep=lambda: [demux_path(layout())], until=until)
+    if until is not None:
+        return dir_path
+
+    reads_data = layout()
+    vis_path = demux_vis_path(reads_data, output_vis_path)
+    pickle.dump(reads_data, open(reads_data_path, "wb"))
     print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish creating visualization\n")
 
     print(f"Visualization file is located in {vis_path}\n"
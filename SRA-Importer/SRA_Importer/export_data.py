@@ -1,11 +1,25 @@
 from __future__ import annotations
 
 import datetime
+import json
 import os
 import pickle
-
+from typing import Callable
+
+from .artifacts import export_table_tsv, export_member
+from .backends import run_qiime, use_backend, CliBackend, ArtifactApiBackend
+from .cache import ArtifactCache
+from .instrumentation import RunRecorder
+from .quality import profile_reads, suggest_trim_trunc
+from .stages import Stage, RunState, run_stages
+from .pipeline import load_config
+from .storage import StoragePolicy, storage_policy
+from .taxonomy import TaxonomyCache, classify_taxonomy
 from .utilities import ReadsData, run_cmd, download_classifier_url, check_conda_qiime2
 
+# the paths of the final artifacts of the last export() of a run, read by merge_runs()
+ARTIFACTS_FILE = "artifacts.json"
+
 
 def trim_trunc_check(reads_data: ReadsData, trim: int | tuple[int, int], trunc: int | tuple[int, int]):
     if reads_data.fwd and reads_data.rev:
@@ -18,12 +32,41 @@ def trim_trunc_check(reads_data: ReadsData, trim: int | tuple[int, int], trunc:
             raise ValueError("The read consist of both forward and reverse, "
                              "so 'trim' and 'trunc' must be tuples of 2 integers.\n"
                              f"Got tuples of length {len(trim)}, {len(trunc)}.")
+        return
     if not isinstance(trim, int) or not isinstance(trunc, int):
         raise TypeError("The read consist of only forward, "
                         "so 'trim' and 'trunc' must be integers.\n"
                         f"Got {type(trim)}, {type(trunc)}.")
 
 
+def auto_trim_trunc(reads_data: ReadsData, trim: int | tuple[int, int] | str, trunc: int | tuple[int, int] | str,
+                    quality_threshold: int = 25, min_overlap: int = 12, amplicon_length: int | None = None,
+                    sample_size: int | None = None):
+    """
+    replace an "auto" trim or trunc by the values suggested from the quality of the reads under fastq/,
+    and record the chosen values in trim_trunc.json of the run directory.
+    an "auto" trunc of paired reads needs `amplicon_length`, otherwise the reads may not overlap and dada2 would
+    drop most of them when merging.
+    """
+    paired = reads_data.fwd and reads_data.rev
+    if paired and trunc == "auto" and amplicon_length is None:
+        raise ValueError("amplicon_length must be given with trunc='auto' for paired reads, "
+                         "so the truncated forward and reverse reads still overlap.")
+    profiles = profile_reads(reads_data.dir_path, sample_size=sample_size)[:2 if paired else 1]
+    suggested = suggest_trim_trunc(profiles, threshold=quality_threshold,
+                                   min_overlap=min_overlap, amplicon_length=amplicon_length)
+    trim = suggested["trim"] if trim == "auto" else trim
+    trunc = suggested["trunc"] if trunc == "auto" else trunc
+    trim_trunc_check(reads_data, trim, trunc)
+
+    with open(os.path.join(reads_data.dir_path, "trim_trunc.json"), "w") as f:
+        json.dump({"trim": trim, "trunc": trunc, "suggested": suggested, "quality_threshold": quality_threshold,
+                   "min_overlap": min_overlap, "amplicon_length": amplicon_length, "sample_size": sample_size},
+                  f, indent=2)
+    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Chose trim={trim} and trunc={trunc}")
+    return trim, trunc
+
+
 def classifier_exists(classifier_path: str):
     if not (os.path.exists(classifier_path) and os.path.isfile(classifier_path)):
         raise FileNotFoundError("Classifier not found! Please give the right path to the classifier.\n"
@@ -51,80 +94,97 @@ def output_files_check(otu_output_file: str, taxonomy_output_file: str):
 
 
 def qiime_dada2(reads_data: ReadsData, input_path: str,
-                left: int | tuple[int, int], right: int | tuple[int, int], threads: int = 12):
+                left: int | tuple[int, int], right: int | tuple[int, int], threads: int = 12,
+                output_path: str | None = None, chimera_method: str = "consensus"):
     paired = reads_data.fwd and reads_data.rev
+    output_path = output_path or os.path.join(reads_data.dir_path, "qza")
 
-    trim_range = ["--p-trim-left-f", str(left[0]), "--p-trim-left-r", str(left[1])] if paired \
-        else ["--p-trim-left", str(left)]
-    trunc_range = ["--p-trunc-len-f", str(right[0]), "--p-trunc-len-r", str(right[1])] if paired \
-        else ["--p-trunc-len", str(right)]
+    trim_range = {"trim_left_f": left[0], "trim_left_r": left[1]} if paired else {"trim_left": left}
+    trunc_range = {"trunc_len_f": right[0], "trunc_len_r": right[1]} if paired else {"trunc_len": right}
 
-    command = [
-                  "qiime", "dada2", "denoise-paired" if paired else "denoise-single",
-                  "--i-demultiplexed-seqs", input_path,
-              ] + trim_range + trunc_range + [
-                  "--o-table", os.path.join(reads_data.dir_path, "qza", "dada2_table.qza"),
-                  "--p-n-threads", str(threads),
-                  "--p-chimera-method", "consensus",
-                  "--o-representative-sequences", os.path.join(reads_data.dir_path, "qza", "dada2_rep-seqs.qza"),
-                  "--o-denoising-stats", os.path.join(reads_data.dir_path, "qza", "dada2_denoising-stats.qza"),
-              ]
-    run_cmd(command)
+    run_qiime("dada2", "denoise-paired" if paired else "denoise-single",
+              inputs={"demultiplexed_seqs": input_path},
+              params={**trim_range, **trunc_range, "n_threads": threads, "chimera_method": chimera_method},
+              outputs={"table": os.path.join(output_path, "dada2_table.qza"),
+                       "representative_sequences": os.path.join(output_path, "dada2_rep-seqs.qza"),
+                       "denoising_stats": os.path.join(output_path, "dada2_denoising-stats.qza")})
 
 
-def cluster_features(reads_data: ReadsData):
+def qiime_deblur(reads_data: ReadsData, input_path: str, trim_length: int, threads: int = 12):
+    """
+    join paired reads, filter them by quality and denoise them with deblur
+    """
     qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
-    command = [
-        "qiime", "vsearch", "cluster-features-de-novo",
-        "--i-table", qza_path("dada2_table.qza"),
-        "--i-sequences", qza_path("dada2_rep-seqs.qza"),
-        "--p-perc-identity", "0.99",
-        "--o-clustered-table", qza_path("table-dn-99.qza"),
-        "--o-clustered-sequences", qza_path("rep-seqs-dn-99.qza")
-    ]
-    run_cmd(command)
+    if reads_data.fwd and reads_data.rev:
+        run_qiime("vsearch", "join-pairs", inputs={"demultiplexed_seqs": input_path},
+                  outputs={"joined_sequences": qza_path("demux-joined.qza")})
+        input_path = qza_path("demux-joined.qza")
+    run_qiime("quality-filter", "q-score", inputs={"demux": input_path},
+              outputs={"filtered_sequences": qza_path("demux-filtered.qza"),
+                       "filter_stats": qza_path("demux-filter-stats.qza")})
+    run_qiime("deblur", "denoise-16S", inputs={"demultiplexed_seqs": qza_path("demux-filtered.qza")},
+              params={"trim_length": trim_length, "sample_stats": True, "jobs_to_start": threads},
+              outputs={"table": qza_path("deblur_table.qza"),
+                       "representative_sequences": qza_path("deblur_rep-seqs.qza"),
+                       "stats": qza_path("deblur_stats.qza")})
+
+
+def cluster_paths(reads_data: ReadsData, perc_identity: float = 0.99):
+    qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
+    return qza_path(f"table-dn-{perc_identity * 100:g}.qza"), qza_path(f"rep-seqs-dn-{perc_identity * 100:g}.qza")
 
 
-def assign_taxonomy(reads_data: ReadsData, classifier_path: str):
+def cluster_features(reads_data: ReadsData, perc_identity: float = 0.99,
+                     table_path: str | None = None, sequences_path: str | None = None):
     qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
-    command = [
-        "qiime", "feature-classifier", "classify-sklearn",
-        "--i-reads", qza_path("rep-seqs-dn-99.qza"),
-        "--i-classifier", classifier_path,
-        "--o-classification", qza_path("gg-13-8-99-nb-classified.qza")
-    ]
-    run_cmd(command)
+    clustered_table, clustered_sequences = cluster_paths(reads_data, perc_identity)
+    run_qiime("vsearch", "cluster-features-de-novo",
+              inputs={"table": table_path or qza_path("dada2_table.qza"),
+                      "sequences": sequences_path or qza_path("dada2_rep-seqs.qza")},
+              params={"perc_identity": perc_identity},
+              outputs={"clustered_table": clustered_table, "clustered_sequences": clustered_sequences})
 
 
-def clean_taxonomy1(reads_data: ReadsData):
+def assign_taxonomy(reads_data: ReadsData, classifier_path: str, jobs: int = 1, batch_size: int = 20_000,
+                    memory_gb: float | None = None, cache: TaxonomyCache | None = None,
+                    sequences_path: str | None = None):
     qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
-    command = [
-        "qiime", "taxa", "filter-table",
-        "--i-table", qza_path("table-dn-99.qza"),
-        "--i-taxonomy", qza_path("gg-13-8-99-nb-classified.qza"),
-        "--p-exclude", "mitochondria,chloroplast",
-        "--o-filtered-table", qza_path("clean_table.qza")
-    ]
-    run_cmd(command)
+    classify_taxonomy(sequences_path or qza_path("rep-seqs-dn-99.qza"), classifier_path,
+                      qza_path("gg-13-8-99-nb-classified.qza"),
+                      jobs=jobs, batch_size=batch_size, memory_gb=memory_gb, cache=cache)
 
 
-def clean_taxonomy2(reads_data: ReadsData):
+def clean_taxonomy1(reads_data: ReadsData, exclude: str = "mitochondria,chloroplast", table_path: str | None = None):
     qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
-    command = [
-        "qiime", "feature-table", "filter-features",
-        "--i-table", qza_path("clean_table.qza"),
-        "--p-min-samples", "3",
-        "--p-min-frequency", "10",
-        "--o-filtered-table", qza_path("feature-frequency-filtered-table.qza")
-    ]
-    run_cmd(command)
+    run_qiime("taxa", "filter-table",
+              inputs={"table": table_path or qza_path("table-dn-99.qza"),
+                      "taxonomy": qza_path("gg-13-8-99-nb-classified.qza")},
+              params={"exclude": exclude},
+              outputs={"filtered_table": qza_path("clean_table.qza")})
 
 
-def export_otu(reads_data: ReadsData, output_file: str):
+def clean_taxonomy2(reads_data: ReadsData, min_samples: int = 3, min_frequency: int = 10,
+                    table_path: str | None = None):
+    qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
+    run_qiime("feature-table", "filter-features",
+              inputs={"table": table_path or qza_path("clean_table.qza")},
+              params={"min_samples": min_samples, "min_frequency": min_frequency},
+              outputs={"filtered_table": qza_path("feature-frequency-filtered-table.qza")})
+
+
+def export_otu(reads_data: ReadsData, output_file: str, in_process: bool = True, table_path: str | None = None):
+    table_path = table_path or os.path.join(reads_data.dir_path, "qza", "feature-frequency-filtered-table.qza")
+    if in_process:
+        try:
+            export_table_tsv(table_path, output_file)
+            return
+        except ImportError:
+            print("WARNING: h5py is not installed, exporting the OTU table with qiime and biom instead.")
+
     # export
     command = [
         "qiime", "tools", "export",
-        "--input-path", os.path.join(reads_data.dir_path, "qza", "feature-frequency-filtered-table.qza"),
+        "--input-path", table_path,
         "--output-path", os.path.join(reads_data.dir_path, "exports")
     ]
     run_cmd(command)
@@ -139,11 +199,16 @@ def export_otu(reads_data: ReadsData, output_file: str):
     run_cmd(command)
 
 
-def export_taxonomy(reads_data: ReadsData, output_file: str):
+def export_taxonomy(reads_data: ReadsData, output_file: str, in_process: bool = True):
+    taxonomy_path = os.path.join(reads_data.dir_path, "qza", "gg-13-8-99-nb-classified.qza")
+    if in_process:
+        export_member(taxonomy_path, "taxonomy.tsv", output_file)
+        return
+
     # export
     command = [
         "qiime", "tools", "export",
-        "--input-path", os.path.join(reads_data.dir_path, "qza", "gg-13-8-99-nb-classified.qza"),
+        "--input-path", taxonomy_path,
         "--output-path", os.path.join(reads_data.dir_path, "exports")
     ]
     run_cmd(command)
@@ -153,41 +218,128 @@ def export_taxonomy(reads_data: ReadsData, output_file: str):
     run_cmd(command)
 
 
-def export(*, output_dir: str, trim: int | tuple[int, int], trunc: int | tuple[int, int], classifier_file: str,
-           otu_output_file: str, taxonomy_output_file: str, threads: int = 12):
+def export_stages(reads_data: ReadsData, config: dict, demux_path: str,
+                  trim: int | tuple[int, int], trunc: int | tuple[int, int], classifier_file: str,
+                  otu_output_file: str, taxonomy_output_file: str, threads: int = 12,
+                  taxonomy_kwargs: dict | None = None):
+    """
+    build the stage graph of export() from a config loaded by load_config.
+    the paths of the table and the sequences change as stages are added, so the stage functions bind them as defaults.
+    return the stages and the paths of the final table, sequences and taxonomy artifacts.
+    """
+    qza_path = lambda filename: os.path.join(reads_data.dir_path, "qza", filename)
+    taxonomy_path = qza_path("gg-13-8-99-nb-classified.qza")
+    denoise = config["denoise"]
+    if denoise["method"] == "dada2":
+        table, sequences, table_stage = qza_path("dada2_table.qza"), qza_path("dada2_rep-seqs.qza"), "qiime_dada2"
+        # the default chimera method is left out, so runs and sweeps keep sharing their cache entries
+        dada2_params = {"trim": trim, "trunc": trunc}
+        if denoise["chimera_method"] != "consensus":
+            dada2_params["chimera_method"] = denoise["chimera_method"]
+        stages = [
+            Stage("qiime_dada2", description="dada2", cacheable=True,
+                  func=lambda: qiime_dada2(reads_data, demux_path, left=trim, right=trunc, threads=threads,
+                                           chimera_method=denoise["chimera_method"]),
+                  inputs=[demux_path], params=dada2_params,
+                  outputs=[table, sequences, qza_path("dada2_denoising-stats.qza")]),
+        ]
+    else:
+        trim_length = denoise["trim_length"]
+        if trim_length is None:
+            if reads_data.fwd and reads_data.rev:
+                raise ValueError("The reads are paired, so the length of the joined reads must be given "
+                                 "as 'trim_length' of the 'denoise' config.")
+            trim_length = trunc
+        table, sequences, table_stage = qza_path("deblur_table.qza"), qza_path("deblur_rep-seqs.qza"), "qiime_deblur"
+        stages = [
+            Stage("qiime_deblur", description="deblur", cacheable=True,
+                  func=lambda: qiime_deblur(reads_data, demux_path, trim_length=trim_length, threads=threads),
+                  inputs=[demux_path], params={**denoise, "trim_length": trim_length},
+                  outputs=[table, sequences, qza_path("deblur_stats.qza")]),
+        ]
+
+    if config["cluster"] is not None:
+        clustered_table, clustered_sequences = cluster_paths(reads_data, config["cluster"]["perc_identity"])
+        stages.append(
+            Stage("cluster_features", description="clustering features", cacheable=True,
+                  func=lambda table=table, sequences=sequences: cluster_features(
+                      reads_data, table_path=table, sequences_path=sequences, **config["cluster"]),
+                  inputs=[table, sequences], params=config["cluster"],
+                  outputs=[clustered_table, clustered_sequences], after=[table_stage]))
+        table, sequences, table_stage = clustered_table, clustered_sequences, "cluster_features"
+
+    stages.append(
+        Stage("assign_taxonomy", description="assigning taxonomy", cacheable=True,
+              func=lambda sequences=sequences: assign_taxonomy(reads_data, classifier_file, sequences_path=sequences,
+                                                               **(taxonomy_kwargs or {})),
+              inputs=[sequences, os.path.abspath(classifier_file)], outputs=[taxonomy_path], after=[table_stage]))
+
+    # the filters run next to the taxonomy export, and without the taxa filter also next to the classification
+    filter_taxa, filter_features = config["filter_taxa"], config["filter_features"]
+    if filter_taxa is not None or filter_features is not None:
+        filtered = ([qza_path("clean_table.qza")] if filter_taxa is not None else []) + \
+                   ([qza_path("feature-frequency-filtered-table.qza")] if filter_features is not None else [])
+
+        def clean_taxonomy(table_path: str):
+            if filter_taxa is not None:
+                clean_taxonomy1(reads_data, table_path=table_path, **filter_taxa)
+                table_path = qza_path("clean_table.qza")
+            if filter_features is not None:
+                clean_taxonomy2(reads_data, table_path=table_path, **filter_features)
+
+        stages.append(
+            Stage("clean_taxonomy", description="cleaning taxonomy", cacheable=True,
+                  func=lambda table_path=table: clean_taxonomy(table_path),
+                  inputs=[table] + ([taxonomy_path] if filter_taxa is not None else []),
+                  params={"filter_taxa": filter_taxa, "filter_features": filter_features}, outputs=filtered,
+                  after=[table_stage] + (["assign_taxonomy"] if filter_taxa is not None else [])))
+        table, table_stage = filtered[-1], "clean_taxonomy"
+
+    stages += [
+        Stage("export_otu", description="exporting OTU",
+              func=lambda table=table: export_otu(reads_data, otu_output_file, table_path=table),
+              inputs=[table], outputs=[os.path.abspath(otu_output_file)], after=[table_stage]),
+        Stage("export_taxonomy", description="exporting taxonomy",
+              func=lambda: export_taxonomy(reads_data, taxonomy_output_file),
+              inputs=[taxonomy_path], outputs=[os.path.abspath(taxonomy_output_file)], after=["assign_taxonomy"]),
+    ]
+    return stages, {"table": table, "sequences": sequences, "taxonomy": taxonomy_path}
+
+
+def export(*, output_dir: str, trim: int | tuple[int, int] | str, trunc: int | tuple[int, int] | str,
+           classifier_file: str, otu_output_file: str, taxonomy_output_file: str, threads: int = 12,
+           quality_threshold: int = 25, min_overlap: int = 12, amplicon_length: int | None = None,
+           quality_sample_size: int | None = 100_000,
+           resume: bool = True, force_from: str | None = None,
+           cache_dir: str | None = None, cache_max_gb: float = 50,
+           taxonomy_jobs: int = 1, taxonomy_batch_size: int = 20_000, taxonomy_memory_gb: float | None = None,
+           taxonomy_cache_file: str | None = None, config: str | dict | None = None,
+           callback: Callable[[dict], None] | None = None, storage: StoragePolicy | dict | None = None,
+           backend: str | CliBackend | ArtifactApiBackend = "cli"):
     check_conda_qiime2()
 
     reads_data: ReadsData = pickle.load(open(os.path.join(output_dir, "reads_data.pkl"), "rb"))
+    if trim == "auto" or trunc == "auto":
+        trim, trunc = auto_trim_trunc(reads_data, trim, trunc, quality_threshold=quality_threshold,
+                                      min_overlap=min_overlap, amplicon_length=amplicon_length,
+                                      sample_size=quality_sample_size)
     trim_trunc_check(reads_data, trim, trunc)
     output_files_check(otu_output_file, taxonomy_output_file)
     classifier_exists(classifier_file)
 
     paired = reads_data.rev and reads_data.fwd
     output_path = os.path.join(reads_data.dir_path, "qza", f"demux-{'paired' if paired else 'single'}-end.qza")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start dada2 (1/6)")
-    qiime_dada2(reads_data, output_path, left=trim, right=trunc, threads=threads)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish dada2 (1/6)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start clustering features (2/6)")
-    cluster_features(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish clustering features (2/6)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start assigning taxonomy (3/6)")
-    assign_taxonomy(reads_data, classifier_file)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish assigning taxonomy (3/6)")
-
     run_cmd(["mkdir", os.path.join(reads_data.dir_path, "exports")])
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start cleaning taxonomy (4/6)")
-    clean_taxonomy1(reads_data)
-    clean_taxonomy2(reads_data)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish cleaning taxonomy (4/6)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start exporting OTU (5/6)")
-    export_otu(reads_data, otu_output_file)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish exporting OTU (5/6)")
-
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Start exporting taxonomy (6/6)")
-    export_taxonomy(reads_data, taxonomy_output_file)
-    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Finish exporting taxonomy (6/6)")
+    taxonomy_cache = TaxonomyCache(taxonomy_cache_file) if taxonomy_cache_file is not None else None
+    stages, artifacts = export_stages(reads_data, load_config(config), output_path, trim, trunc, classifier_file,
+                                      otu_output_file, taxonomy_output_file, threads=threads,
+                                      taxonomy_kwargs={"jobs": taxonomy_jobs, "batch_size": taxonomy_batch_size,
+                                                       "memory_gb": taxonomy_memory_gb, "cache": taxonomy_cache})
+    with open(os.path.join(reads_data.dir_path, ARTIFACTS_FILE), "w") as f:
+        json.dump(artifacts, f, indent=2)
+
+    cache = ArtifactCache(cache_dir, max_size=int(cache_max_gb * 2 ** 30)) if cache_dir is not None else None
+    with RunRecorder(os.path.join(reads_data.dir_path, "run_log.jsonl"), callback).activate(), \
+            use_backend(backend):
+        run_stages(RunState(reads_data.dir_path), stages, resume=resume, force_from=force_from, cache=cache,
+                   storage=storage_policy(storage), keep=list(artifacts.values()))
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable
+
+_recorder = contextvars.ContextVar("sra_importer_recorder", default=None)
+_stage = contextvars.ContextVar("sra_importer_stage", default=None)
+
+STDERR_TAIL = 4000
+
+_print_lock = threading.Lock()
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="milliseconds")
+
+
+def timestamp():
+    # the time of the progress lines and of the run and batch reports
+    return datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+
+
+def progress(message: str):
+    """
+    print a timestamped progress line. stages and projects run in threads, so every line is printed whole
+    """
+    with _print_lock:
+        print(f"{timestamp()} -- {message}")
+
+
+def path_size(path: str):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    a thread pool whose tasks run in the context of the submitting thread,
+    so commands run by the workers are recorded under the active run and stage
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class RunRecorder:
+    """
+    collects a JSON-lines event log of a run. every event is appended to `log_path` and passed to `callback`.
+    there are two kinds of events:
+     - "command": a single subprocess, with its exit status, wall time, CPU time and peak RSS (from wait4).
+     - "stage": a whole stage, with its status, wall time, the CPU time and peak RSS of its commands,
+       the bytes of its outputs and its commands.
+    """
+
+    def __init__(self, log_path: str | None = None, callback: Callable[[dict], None] | None = None):
+        self.log_path = log_path
+        self.callback = callback
+        self._lock = threading.Lock()
+
+    def emit(self, event: dict):
+        event = {"time": _now(), **event}
+        with self._lock:
+            if self.log_path is not None:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps(event) + "\n")
+            if self.callback is not None:
+                self.callback(event)
+
+    @contextmanager
+    def activate(self):
+        token = _recorder.set(self)
+        try:
+            yield self
+        finally:
+            _recorder.reset(token)
+
+
+def record_command(command: list, exit_status: int, wall_time: float, rusage, stderr: str):
+    """
+    called by run_cmd for every finished command. `rusage` is None where wait4 is not available.
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        return
+    stage = _stage.get()
+    event = {
+        "event": "command",
+        "stage": stage["stage"] if stage is not None else None,
+        "command": [str(c) for c in command],
+        "exit_status": exit_status,
+        "wall_time": round(wall_time, 3),
+        "cpu_time": round(rusage.ru_utime + rusage.ru_stime, 3) if rusage is not None else None,
+        "peak_rss_kb": rusage.ru_maxrss if rusage is not None else None,
+        "output_blocks": rusage.ru_oublock if rusage is not None else None,
+    }
+    if exit_status != 0:
+        event["stderr"] = stderr[-STDERR_TAIL:]
+    if stage is not None:
+        with stage["lock"]:
+            stage["commands"].append(event)
+    recorder.emit(event)
+
+
+def record_stage_status(name: str, status: str):
+    """
+    record a stage which did not run, e.g. skipped since its outputs are up to date
+    """
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.emit({"event": "stage", "stage": name, "status": status})
+
+
+@contextmanager
+def stage_record(name: str, outputs: Callable[[], list] = list):
+    """
+    measure the stage running inside the block and the commands it runs
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+
+    stage = {"stage": name, "commands": [], "lock": threading.Lock()}
+    token = _stage.set(stage)
+    start = time.perf_counter()
+    status, error = "done", None
+    try:
+        yield
+    except BaseException as e:
+        status, error = "failed", str(e)
+        raise
+    finally:
+        _stage.reset(token)
+        commands = stage["commands"]
+        cpu_times = [c["cpu_time"] for c in commands if c["cpu_time"] is not None]
+        peak_rss = [c["peak_rss_kb"] for c in commands if c["peak_rss_kb"] is not None]
+        failed = [c["exit_status"] for c in commands if c["exit_status"] != 0]
+        event = {
+            "event": "stage",
+            "stage": name,
+            "status": status,
+            "wall_time": round(time.perf_counter() - start, 3),
+            "cpu_time": round(sum(cpu_times), 3),
+            "peak_rss_kb": max(peak_rss, default=None),
+            "bytes_written": sum(path_size(p) for p in outputs()),
+            "exit_status": failed[0] if failed else 0,
+            "commands": [" ".join(c["command"]) for c in commands],
+        }
+        if error is not None:
+            event["error"] = error
+        recorder.emit(event)
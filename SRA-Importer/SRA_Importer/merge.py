@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+
+import numpy as np
+from scipy import sparse
+
+from .artifacts import open_member, read_sequences, write_table_tsv
+from .export_data import ARTIFACTS_FILE
+
+MD5_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def feature_key(feature_id: str, sequences: dict | None = None):
+    # qiime2 names features by the md5 of their sequence. other ids are hashed from the sequence when it is known
+    if MD5_PATTERN.match(feature_id) or not sequences or feature_id not in sequences:
+        return feature_id
+    return hashlib.md5(sequences[feature_id].upper().encode()).hexdigest()
+
+
+def feature_keys(rep_seqs: str | None):
+    """
+    return the feature_key function of a run. its sequences are read from `rep_seqs` only once a feature id
+    is not an md5 hash, which is never for dada2 and vsearch, and are released with the function.
+    """
+    loaded = {}
+
+    def key(feature_id: str):
+        if rep_seqs is None or MD5_PATTERN.match(feature_id):
+            return feature_id
+        if "sequences" not in loaded:
+            loaded["sequences"] = read_sequences(rep_seqs)
+        return feature_key(feature_id, loaded["sequences"])
+    return key
+
+
+def iter_biom(biom_path: str):
+    """
+    yield (feature id, sample ids, counts) for every feature row of a biom table.
+    HDF5 tables (.biom, or the table inside a FeatureTable .qza) are read one row at a time through h5py;
+    TSV tables (as written by 'biom convert --to-tsv') line by line.
+    """
+    if biom_path.endswith(".qza"):
+        with open_member(biom_path, "feature-table.biom") as member:
+            biom_file = io.BytesIO(member.read())
+    else:
+        biom_file = biom_path
+
+    if biom_path.endswith((".biom", ".qza")):
+        import h5py
+        with h5py.File(biom_file, "r") as f:
+            feature_ids = [i.decode() if isinstance(i, bytes) else i for i in f["observation/ids"][:]]
+            sample_ids = np.array([i.decode() if isinstance(i, bytes) else i for i in f["sample/ids"][:]], dtype=object)
+            matrix = f["observation/matrix"]
+            indptr = matrix["indptr"][:]
+            for row, feature_id in enumerate(feature_ids):
+                start, end = indptr[row], indptr[row + 1]
+                yield feature_id, sample_ids[matrix["indices"][start:end]], matrix["data"][start:end]
+        return
+
+    with open(biom_path) as f:
+        sample_ids = None
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#OTU ID"):
+                sample_ids = np.array(fields[1:], dtype=object)
+            elif line.startswith("#") or sample_ids is None:
+                continue
+            else:
+                counts = np.array(fields[1:], dtype=np.float64)
+                nonzero = np.nonzero(counts)[0]
+                yield fields[0], sample_ids[nonzero], counts[nonzero]
+
+
+class _Index(dict):
+    # assigns consecutive indices to new keys, in order of appearance
+    def __missing__(self, key):
+        self[key] = len(self)
+        return self[key]
+
+
+def merge_feature_tables(tables: list[str], rep_seqs: list[str | None] | None = None,
+                         sample_prefixes: list[str] | None = None):
+    """
+    merge biom tables into a single sparse matrix of features by samples.
+    features are deduplicated by their sequence hash (from the matching `rep_seqs` artifact when their ids are not),
+    and counts of the same feature in the same sample are summed.
+    only the non-zero counts are kept in memory.
+    return the CSR matrix, the feature keys and the sample ids.
+    """
+    features, samples = _Index(), _Index()
+    rows, cols, data = [], [], []
+    for i, table in enumerate(tables):
+        key = feature_keys(rep_seqs[i] if rep_seqs is not None else None)
+        prefix = sample_prefixes[i] if sample_prefixes is not None else ""
+        for feature_id, sample_ids, counts in iter_biom(table):
+            row = features[key(feature_id)]
+            rows.append(np.full(len(counts), row, dtype=np.int64))
+            cols.append(np.fromiter((samples[prefix + s] for s in sample_ids), dtype=np.int64, count=len(sample_ids)))
+            data.append(np.asarray(counts, dtype=np.float64))
+
+    matrix = sparse.coo_matrix((np.concatenate(data) if data else np.zeros(0),
+                                (np.concatenate(rows) if rows else np.zeros(0, np.int64),
+                                 np.concatenate(cols) if cols else np.zeros(0, np.int64))),
+                               shape=(len(features), len(samples))).tocsr()
+    matrix.sum_duplicates()
+    return matrix, list(features), list(samples)
+
+
+def _open_taxonomy(taxonomy: str):
+    # a taxonomy .qza is read in place, a taxonomy.tsv from the disk
+    if taxonomy.endswith(".qza"):
+        with open_member(taxonomy, "taxonomy.tsv") as member:
+            return io.StringIO(member.read().decode("utf-8"))
+    return open(taxonomy)
+
+
+def merge_taxonomies(taxonomies: list[str], output_file: str, rep_seqs: list[str | None] | None = None):
+    """
+    stream taxonomy.tsv files (or FeatureData[Taxonomy] artifacts) into a single one,
+    keeping the first assignment of every feature
+    """
+    seen = set()
+    with open(output_file, "w", newline="") as out:
+        tsv_writer = csv.writer(out, delimiter="\t")
+        tsv_writer.writerow(["Feature ID", "Taxon", "Confidence"])
+        for i, taxonomy in enumerate(taxonomies):
+            key = feature_keys(rep_seqs[i] if rep_seqs is not None else None)
+            with _open_taxonomy(taxonomy) as f:
+                for row in csv.reader(f, delimiter="\t"):
+                    if not row or row[0] in {"Feature ID", "#q2:types"}:
+                        continue
+                    feature = key(row[0])
+                    if feature not in seen:
+                        seen.add(feature)
+                        tsv_writer.writerow([feature] + row[1:])
+
+
+def write_npz(path: str, matrix: sparse.csr_matrix, feature_ids: list[str], sample_ids: list[str]):
+    np.savez_compressed(path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                        shape=np.array(matrix.shape), feature_ids=np.array(feature_ids), sample_ids=np.array(sample_ids))
+
+
+def load_npz(path: str):
+    """
+    return the matrix, the feature ids and the sample ids saved by write_npz
+    """
+    with np.load(path) as f:
+        matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        return matrix, list(f["feature_ids"]), list(f["sample_ids"])
+
+
+def write_biom(path: str, matrix: sparse.csr_matrix, feature_ids: list[str], sample_ids: list[str]):
+    """
+    write a BIOM 2.1 HDF5 table
+    """
+    import h5py
+    string = h5py.special_dtype(vlen=str)
+    with h5py.File(path, "w") as f:
+        f.attrs.update({"id": "No Table ID", "type": "OTU table", "format-url": "http://biom-format.org",
+                        "format-version": (2, 1), "generated-by": "SRA-Importer",
+                        "creation-date": datetime.datetime.now().isoformat(),
+                        "shape": matrix.shape, "nnz": matrix.nnz})
+        for axis, ids, axis_matrix in (("observation", feature_ids, matrix), ("sample", sample_ids, matrix.T.tocsr())):
+            group = f.create_group(axis)
+            group.create_dataset("ids", data=np.array(ids, dtype=object), dtype=string)
+            group.create_group("metadata")
+            group.create_group("group-metadata")
+            matrix_group = group.create_group("matrix")
+            matrix_group.create_dataset("data", data=axis_matrix.data, compression="gzip")
+            matrix_group.create_dataset("indices", data=axis_matrix.indices.astype(np.int32), compression="gzip")
+            matrix_group.create_dataset("indptr", data=axis_matrix.indptr.astype(np.int32), compression="gzip")
+
+
+def _run_file(run_dir: str, kind: str, artifact: str, exported: str | None = None):
+    # the final artifacts of the pipeline are listed in artifacts.json, older runs have them under fixed names in qza/,
+    # and the files under exports/ are left by even older runs
+    candidates = [os.path.join(run_dir, "qza", artifact)] + ([os.path.join(run_dir, "exports", exported)]
+                                                             if exported is not None else [])
+    artifacts_path = os.path.join(run_dir, ARTIFACTS_FILE)
+    if os.path.isfile(artifacts_path):
+        with open(artifacts_path) as f:
+            candidates.insert(0, json.load(f)[kind])
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    if exported is None:
+        return None
+    raise FileNotFoundError(f"{artifact} was not found in {run_dir}. Run export() on this directory first.")
+
+
+def merge_runs(*, run_dirs: list[str], output_file: str, taxonomy_output_file: str | None = None,
+               tsv_output_file: str | None = None, prefix_samples: bool = False):
+    """
+    merge the exported OTU and taxonomy tables of several runs, created by export().
+    the merged table is written to `output_file`, as .npz (see load_npz) or as a BIOM HDF5 .biom,
+    and optionally also as a TSV. with `prefix_samples`, sample ids are prefixed by their run directory name,
+    otherwise counts of the same sample in different runs are summed.
+    return the CSR matrix, the feature keys and the sample ids.
+    """
+    extension = output_file.split(".")[-1]
+    if extension not in {"npz", "biom"}:
+        raise ValueError(f"output_file must be a npz/biom file. Instead got a {extension} file.")
+
+    tables = [_run_file(d, "table", "feature-frequency-filtered-table.qza", "feature-table.biom") for d in run_dirs]
+    taxonomies = [_run_file(d, "taxonomy", "gg-13-8-99-nb-classified.qza", "taxonomy.tsv") for d in run_dirs]
+    rep_seqs = [_run_file(d, "sequences", "rep-seqs-dn-99.qza") for d in run_dirs]
+    prefixes = [os.path.basename(os.path.normpath(d)) + "_" for d in run_dirs] if prefix_samples else None
+
+    matrix, feature_ids, sample_ids = merge_feature_tables(tables, rep_seqs, prefixes)
+    (write_npz if extension == "npz" else write_biom)(output_file, matrix, feature_ids, sample_ids)
+    if tsv_output_file is not None:
+        write_table_tsv(tsv_output_file, matrix, feature_ids, sample_ids)
+    if taxonomy_output_file is not None:
+        merge_taxonomies(taxonomies, taxonomy_output_file, rep_seqs)
+    return matrix, feature_ids, sample_ids
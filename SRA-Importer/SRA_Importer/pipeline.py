@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import json
+
+DENOISE_DEFAULTS = {
+    "dada2": {"method": "dada2", "chimera_method": "consensus"},
+    "deblur": {"method": "deblur", "trim_length": None},
+}
+DEFAULT_CONFIG = {
+    "denoise": DENOISE_DEFAULTS["dada2"],
+    "cluster": {"perc_identity": 0.99},
+    "filter_taxa": {"exclude": "mitochondria,chloroplast"},
+    "filter_features": {"min_samples": 3, "min_frequency": 10},
+}
+# the sections which can be set to null to skip their stage
+OPTIONAL_SECTIONS = {"cluster", "filter_taxa", "filter_features"}
+
+
+def load_config(config: str | dict | None = None):
+    """
+    return the pipeline config of export(), read from a JSON file or given as a dict.
+    missing sections and values take their defaults from DEFAULT_CONFIG,
+    and an optional section set to None (null in JSON) skips its stage.
+    """
+    if isinstance(config, str):
+        with open(config) as f:
+            config = json.load(f)
+    config = config or {}
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown config sections {', '.join(sorted(unknown))}. "
+                         f"The sections are {', '.join(DEFAULT_CONFIG)}.")
+
+    loaded = {}
+    for section, defaults in DEFAULT_CONFIG.items():
+        values = config.get(section, defaults)
+        if values is None:
+            if section not in OPTIONAL_SECTIONS:
+                raise ValueError(f"The '{section}' section cannot be skipped.")
+            loaded[section] = None
+            continue
+        if section == "denoise":
+            method = values.get("method", "dada2")
+            if method not in DENOISE_DEFAULTS:
+                raise ValueError(f"denoise method must be one of {', '.join(DENOISE_DEFAULTS)}. Got '{method}'.")
+            defaults = DENOISE_DEFAULTS[method]
+        unknown = set(values) - set(defaults)
+        if unknown:
+            raise ValueError(f"Unknown '{section}' values {', '.join(sorted(unknown))}. "
+                             f"The values are {', '.join(defaults)}.")
+        loaded[section] = {**defaults, **values}
+    return loaded
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import csv
+import gzip
+import itertools
+import os
+import random
+import re
+import zipfile
+
+import numpy as np
+
+from .catalog import scan_fastq, files_by_read
+
+PHRED_OFFSET = 33
+QUALITY_LEVELS = 94
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+# a batch of 300bp reads takes about 40MB while it is counted
+BATCH_SIZE = 10_000
+
+# the fastq files inside a demux artifact are named in the Casava format, e.g. SRR1_0_L001_R1_001.fastq.gz
+CASAVA_PATTERN = re.compile(r"^.+_L\d{3}_R(?P<read>[12])_\d{3}\.fastq\.gz$")
+
+
+class QualityProfile:
+    """
+    per-position histogram of Phred scores. its memory depends only on the read length, not on the number of reads,
+    and the quantiles are exact.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros((0, QUALITY_LEVELS), dtype=np.int64)
+
+    def add(self, qualities: list[bytes]):
+        """
+        add a batch of quality strings, vectorized over the whole batch
+        """
+        if not qualities:
+            return
+        # uint8 scores and int32 indices, so a batch takes a few bytes per base
+        lengths = np.fromiter((len(q) for q in qualities), dtype=np.int32, count=len(qualities))
+        scores = np.frombuffer(b"".join(qualities), dtype=np.uint8)
+        scores = np.clip(scores, PHRED_OFFSET, PHRED_OFFSET + QUALITY_LEVELS - 1) - np.uint8(PHRED_OFFSET)
+        starts = np.repeat(np.cumsum(lengths, dtype=np.int32) - lengths, lengths)
+        indices = np.arange(len(scores), dtype=np.int32)
+        indices -= starts
+        del starts
+        indices *= QUALITY_LEVELS
+        indices += scores
+
+        max_len = int(lengths.max())
+        if max_len > len(self.counts):
+            self.counts = np.vstack([self.counts, np.zeros((max_len - len(self.counts), QUALITY_LEVELS), np.int64)])
+        self.counts[:max_len] += np.bincount(indices, minlength=max_len * QUALITY_LEVELS).reshape(max_len,
+                                                                                                   QUALITY_LEVELS)
+
+    @property
+    def reads(self):
+        # number of reads covering each position
+        return self.counts.sum(axis=1)
+
+    def mean(self):
+        return (self.counts * np.arange(QUALITY_LEVELS)).sum(axis=1) / np.maximum(self.reads, 1)
+
+    def quantiles(self, qs: tuple = QUANTILES):
+        """
+        array of shape (positions, len(qs)) of the per-position Phred quantiles
+        """
+        cumulative = np.cumsum(self.counts, axis=1)
+        thresholds = np.outer(self.reads, qs)
+        return np.stack([(cumulative >= np.maximum(thresholds[:, [i]], 1)).argmax(axis=1)
+                         for i in range(len(qs))], axis=1)
+
+    def write_tsv(self, path: str):
+        quantiles = self.quantiles()
+        with open(path, "w", newline="") as f:
+            tsv_writer = csv.writer(f, delimiter="\t")
+            tsv_writer.writerow(["position", "reads", "mean"] + [f"p{int(q * 100)}" for q in QUANTILES])
+            for position, (reads, mean, row) in enumerate(zip(self.reads, self.mean(), quantiles), 1):
+                tsv_writer.writerow([position, int(reads), round(float(mean), 2)] + [int(v) for v in row])
+
+
+def iter_qualities(fastq_path: str, archive: zipfile.ZipFile | None = None):
+    """
+    yield the quality line of every read of a fastq file, or of a fastq member of `archive`
+    """
+    if archive is not None:
+        with archive.open(fastq_path) as member, gzip.open(member, "rb") as f:
+            for line in itertools.islice(f, 3, None, 4):
+                yield line.rstrip(b"\r\n")
+        return
+    opener = gzip.open if fastq_path.endswith(".gz") else open
+    with opener(fastq_path, "rb") as f:
+        for line in itertools.islice(f, 3, None, 4):
+            yield line.rstrip(b"\r\n")
+
+
+def _batches(qualities, batch_size: int = BATCH_SIZE):
+    while True:
+        batch = list(itertools.islice(qualities, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _reservoir(qualities, sample_size: int, rng: random.Random):
+    # algorithm R, keeps a uniform sample of `sample_size` reads from a stream of unknown length
+    reservoir = []
+    for i, quality in enumerate(qualities):
+        if i < sample_size:
+            reservoir.append(quality)
+        else:
+            j = rng.randrange(i + 1)
+            if j < sample_size:
+                reservoir[j] = quality
+    return reservoir
+
+
+def profile_files(fastq_paths: list[str], sample_size: int | None = None, seed: int = 0,
+                  archive: zipfile.ZipFile | None = None):
+    """
+    profile the reads of all the given files (or members of `archive`) together.
+    with `sample_size`, only a uniform reservoir sample of that many reads is profiled.
+    """
+    profile = QualityProfile()
+    qualities = itertools.chain.from_iterable(iter_qualities(path, archive) for path in fastq_paths)
+    if sample_size is not None:
+        qualities = iter(_reservoir(qualities, sample_size, random.Random(seed)))
+    for batch in _batches(qualities):
+        profile.add(batch)
+    return profile
+
+
+def fastq_files_by_read(fastq_dir: str):
+    """
+    return the forward and the reverse fastq files of a directory, in the layout they are imported with:
+    samples of mixed layouts are single-end, so only their forward reads are profiled.
+    """
+    return files_by_read(scan_fastq(fastq_dir))
+
+
+def demux_files_by_read(archive: zipfile.ZipFile):
+    """
+    return the forward and the reverse fastq members of a demux artifact
+    """
+    fwd, rev = [], []
+    for name in sorted(archive.namelist()):
+        match = CASAVA_PATTERN.match(os.path.basename(name))
+        if name.split("/")[1:2] == ["data"] and match is not None:
+            (rev if match.group("read") == "2" else fwd).append(name)
+    return fwd, rev
+
+
+def _demux_artifact(output_dir: str):
+    # the demux artifact of the run, whose reads are profiled when fastq/ was pruned
+    for layout in ("paired", "single"):
+        path = os.path.join(output_dir, "qza", f"demux-{layout}-end.qza")
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _covered_length(profile: QualityProfile, min_coverage: float):
+    # the last position covered by `min_coverage` of the reads, since dada2 discards reads shorter than trunc
+    coverage = profile.reads / profile.reads.max()
+    return int(np.nonzero(coverage >= min_coverage)[0][-1]) + 1
+
+
+def suggest_cut_points(profile: QualityProfile, threshold: int = 25, min_coverage: float = 0.9):
+    """
+    suggest trim and trunc for a single read direction:
+     - trim is the first position whose median quality reaches `threshold`.
+     - trunc is where the median quality first drops below `threshold` after trim,
+       but not beyond the last position covered by `min_coverage` of the reads.
+    """
+    if len(profile.counts) == 0:
+        return 0, 0
+    good = profile.quantiles((0.5,))[:, 0] >= threshold
+    trim = int(good.argmax()) if good.any() else 0
+    covered = _covered_length(profile, min_coverage)
+    low = np.nonzero(~good[trim:covered])[0]
+    trunc = trim + int(low[0]) if len(low) else covered
+    return trim, max(trunc, trim + 1)
+
+
+def extend_for_overlap(fwd: QualityProfile, rev: QualityProfile, cut_points: list[tuple[int, int]],
+                       amplicon_length: int, min_overlap: int = 12, min_coverage: float = 0.9):
+    """
+    lengthen the truncation of paired reads until they overlap by `min_overlap` over an amplicon of `amplicon_length`,
+    each time extending the read whose next position has the better median quality.
+    """
+    (trim_f, trunc_f), (trim_r, trunc_r) = cut_points
+    median_f, median_r = fwd.quantiles((0.5,))[:, 0], rev.quantiles((0.5,))[:, 0]
+    max_f, max_r = _covered_length(fwd, min_coverage), _covered_length(rev, min_coverage)
+    while trunc_f + trunc_r - amplicon_length < min_overlap:
+        can_f, can_r = trunc_f < max_f, trunc_r < max_r
+        if not (can_f or can_r):
+            raise ValueError(f"The reads are too short to overlap by {min_overlap} over an amplicon "
+                             f"of {amplicon_length}: at most {max_f} forward and {max_r} reverse positions can be kept.")
+        if can_f and (not can_r or median_f[trunc_f] >= median_r[trunc_r]):
+            trunc_f += 1
+        else:
+            trunc_r += 1
+    return [(trim_f, trunc_f), (trim_r, trunc_r)]
+
+
+def profile_reads(output_dir: str, sample_size: int | None = None, seed: int = 0):
+    """
+    profile the forward and reverse reads under <output_dir>/fastq, and save their tables under <output_dir>/quality.
+    if fastq/ was pruned, the reads inside the demux artifact are profiled instead.
+    return the list of profiles, forward first.
+    """
+    fastq_path, archive = os.path.join(output_dir, "fastq"), None
+    fwd, rev = fastq_files_by_read(fastq_path) if os.path.isdir(fastq_path) else ([], [])
+    demux_path = _demux_artifact(output_dir) if not fwd else None
+    if demux_path is not None:
+        archive = zipfile.ZipFile(demux_path)
+        fwd, rev = demux_files_by_read(archive)
+    if not fwd:
+        raise FileNotFoundError(f"No fastq files were found in {fastq_path}.")
+    quality_path = os.path.join(output_dir, "quality")
+    os.makedirs(quality_path, exist_ok=True)
+
+    profiles = []
+    try:
+        for direction, files in (("forward", fwd), ("reverse", rev)):
+            if not files:
+                continue
+            profile = profile_files(files, sample_size=sample_size, seed=seed, archive=archive)
+            profile.write_tsv(os.path.join(quality_path, f"{direction}-quality.tsv"))
+            profiles.append(profile)
+    finally:
+        if archive is not None:
+            archive.close()
+    return profiles
+
+
+def suggest_trim_trunc(profiles: list[QualityProfile], threshold: int = 25, min_coverage: float = 0.9,
+                       min_overlap: int = 12, amplicon_length: int | None = None):
+    """
+    return trim and trunc in the format expected by export(): integers for single-end reads, tuples for paired reads.
+    the overlap of paired reads is enforced only when `amplicon_length` is given.
+    """
+    cut_points = [suggest_cut_points(p, threshold=threshold, min_coverage=min_coverage) for p in profiles]
+    if len(cut_points) == 1:
+        (trim, trunc), = cut_points
+        return {"trim": trim, "trunc": trunc}
+
+    if amplicon_length is not None:
+        cut_points = extend_for_overlap(*profiles, cut_points, amplicon_length=amplicon_length,
+                                        min_overlap=min_overlap, min_coverage=min_coverage)
+    else:
+        print("WARNING: amplicon_length was not given, so the overlap of the forward and reverse reads is not checked.")
+    return {"trim": tuple(c[0] for c in cut_points), "trunc": tuple(c[1] for c in cut_points)}
+
+
+def quality_profile(*, output_dir: str, threshold: int = 25, sample_size: int | None = None,
+                    min_coverage: float = 0.9, min_overlap: int = 12, amplicon_length: int | None = None,
+                    seed: int = 0):
+    """
+    profile the reads under <output_dir>/fastq without importing them to qiime2.
+    the per-position quality tables are saved under <output_dir>/quality,
+    and the suggested 'trim' and 'trunc' for export() are returned as a dict.
+    """
+    profiles = profile_reads(output_dir, sample_size=sample_size, seed=seed)
+    return suggest_trim_trunc(profiles, threshold=threshold, min_coverage=min_coverage,
+                              min_overlap=min_overlap, amplicon_length=amplicon_length)
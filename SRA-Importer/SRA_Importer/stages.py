@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Callable
+
+from .cache import ArtifactCache
+from .instrumentation import ContextThreadPoolExecutor, stage_record, record_stage_status, progress, timestamp
+from .storage import StoragePolicy, check_free_space, remove_path
+
+STATE_FILE = "state.json"
+
+
+def _jsonable(params: dict):
+    # tuples are saved as lists, so parameters are compared the way they are stored
+    return json.loads(json.dumps(params))
+
+
+@dataclass
+class Stage:
+    """
+    a single step of a run.
+    `inputs` and `outputs` are lists of paths, or callables returning them when the paths are only known
+    after an earlier stage finished (e.g. the demux artifact name depends on the reads layout).
+    the outputs of a `cacheable` stage are stored in, and reused from, an ArtifactCache.
+    `after` names the stages it depends on; None means the stage right before it in the list.
+    `consumes` lists the inputs the stage deletes itself (e.g. the .sra files it converted).
+    """
+    name: str
+    func: Callable
+    description: str
+    inputs: list | Callable = field(default_factory=list)
+    outputs: list | Callable = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    cacheable: bool = False
+    after: list[str] | None = None
+    consumes: list = field(default_factory=list)
+
+    def input_paths(self):
+        return list(self.inputs() if callable(self.inputs) else self.inputs)
+
+    def output_paths(self):
+        return list(self.outputs() if callable(self.outputs) else self.outputs)
+
+
+class RunState:
+    """
+    per-run manifest saved as state.json inside the run directory.
+    it records the status, the input/output paths, the parameters and the input content hashes of every stage,
+    and the hashes of the files deleted by the storage policy, so the stages which created or read them stay done.
+    """
+
+    def __init__(self, dir_path: str):
+        self.path = os.path.join(dir_path, STATE_FILE)
+        self._lock = threading.RLock()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.data = json.load(f)
+        else:
+            self.data = {"stages": {}, "digests": {}}
+        self.data.setdefault("pruned", {})
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.data, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def digest(self, path: str):
+        """
+        content hash of a file, cached by size and modification time so unchanged files are read only once.
+        a directory (the raw .sra and .fastq files) is keyed by the name, size and modification time of every file
+        under it, so the raw data is not read again and its files are not listed in state.json.
+        """
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            h = hashlib.blake2b(digest_size=20)
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    stat = os.stat(file_path)
+                    h.update(f"{os.path.relpath(file_path, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+            return h.hexdigest()
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            cached = self.data["digests"].get(path)
+        if cached is not None and cached["key"] == key:
+            return cached["digest"]
+
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        with self._lock:
+            self.data["digests"][path] = {"key": key, "digest": h.hexdigest()}
+        return h.hexdigest()
+
+    def is_done(self, stage: Stage):
+        """
+        True if the stage already finished, all its outputs are present and its inputs and parameters did not change
+        """
+        with self._lock:
+            record = self.data["stages"].get(stage.name)
+        if record is None or record["status"] != "done" or record["params"] != _jsonable(stage.params):
+            return False
+        outputs = stage.output_paths()
+        if record["outputs"] != outputs or not all(os.path.exists(p) or self.is_pruned(p) for p in outputs):
+            return False
+        inputs = stage.input_paths()
+        return record["inputs"] == {p: self.input_digest(p) for p in inputs}
+
+    def is_pruned(self, path: str):
+        with self._lock:
+            return path in self.data["pruned"]
+
+    def input_digest(self, path: str):
+        # a pruned input keeps the digest it had when it was deleted
+        with self._lock:
+            if path in self.data["pruned"]:
+                return self.data["pruned"][path]
+        return self.digest(path)
+
+    def mark_pruned(self, path: str):
+        """
+        record `path` as deleted on purpose, with the digest the stages reading it last recorded
+        """
+        with self._lock:
+            recorded = [r["inputs"][path] for r in self.data["stages"].values()
+                        if r.get("status") == "done" and path in r.get("inputs", {})]
+            self.data["pruned"][path] = recorded[-1] if recorded else self.digest(path)
+            self.save()
+
+    def prune(self, path: str):
+        self.mark_pruned(path)
+        remove_path(path)
+
+    def _update(self, stage: Stage, **record):
+        with self._lock:
+            self.data["stages"].setdefault(stage.name, {}).update(record)
+            self.save()
+
+    def start(self, stage: Stage):
+        self._update(stage, status="running", started=timestamp(), finished=None, error=None,
+                     params=_jsonable(stage.params), inputs={p: self.input_digest(p) for p in stage.input_paths()})
+
+    def finish(self, stage: Stage):
+        with self._lock:
+            for path in stage.output_paths():
+                self.data["pruned"].pop(path, None)
+        self._update(stage, status="done", finished=timestamp(), outputs=stage.output_paths())
+        for path in stage.consumes:
+            self.mark_pruned(path)
+
+    def fail(self, stage: Stage, error: Exception):
+        self._update(stage, status="failed", finished=timestamp(), error=str(error))
+
+
+def stage_dependencies(stages: list[Stage]):
+    """
+    return a dict of every stage name to the names of the stages it runs after.
+    a stage may only depend on stages listed before it, so the list order is always a valid order to run them.
+    """
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stage names must be unique. Got {', '.join(names)}.")
+    dependencies = {}
+    for i, stage in enumerate(stages):
+        after = stage.after if stage.after is not None else names[max(i - 1, 0):i]
+        unknown = [name for name in after if name not in names[:i]]
+        if unknown:
+            raise ValueError(f"Stage '{stage.name}' runs after {', '.join(unknown)}, "
+                             f"which must be stages listed before it.")
+        dependencies[stage.name] = list(after)
+    return dependencies
+
+
+def _dependents(dependencies: dict, name: str):
+    # the stage and every stage depending on it, directly or not
+    found = {name}
+    for stage, after in dependencies.items():
+        if found.intersection(after):
+            found.add(stage)
+    return found
+
+
+def _prerequisites(dependencies: dict, name: str):
+    # the stage and every stage it depends on, directly or not
+    found = {name}
+    for stage in reversed(list(dependencies)):
+        if stage in found:
+            found.update(dependencies[stage])
+    return found
+
+
+def run_stage(state: RunState, stage: Stage, position: str, resume: bool = True, forced: bool = False,
+              cache: ArtifactCache | None = None, min_free_gb: float = 0):
+    if resume and not forced and state.is_done(stage):
+        progress(f"Skip {stage.description}, outputs are up to date ({position})")
+        record_stage_status(stage.name, "skipped")
+        return
+
+    pruned = [p for p in stage.input_paths() if state.is_pruned(p) and not os.path.exists(p)]
+    if pruned:
+        raise FileNotFoundError(f"Stage '{stage.name}' needs {', '.join(pruned)}, which the storage policy deleted. "
+                                f"Rerun the stage creating it with force_from.")
+    check_free_space(os.path.dirname(state.path), min_free_gb, stage.name)
+
+    key = None
+    if cache is not None and stage.cacheable:
+        key = cache.key(stage.name, _jsonable(stage.params), [state.digest(p) for p in stage.input_paths()])
+        if not forced and cache.fetch(key, stage.output_paths()):
+            state.start(stage)
+            state.finish(stage)
+            progress(f"Reuse cached {stage.description} ({position})")
+            record_stage_status(stage.name, "cached")
+            return
+    # old outputs may be hard links to a cache entry, so they are unlinked instead of being overwritten in place
+    for path in stage.output_paths():
+        if os.path.isfile(path):
+            os.remove(path)
+
+    progress(f"Start {stage.description} ({position})")
+    state.start(stage)
+    try:
+        with stage_record(stage.name, stage.output_paths):
+            stage.func()
+            missing = [p for p in stage.output_paths() if not os.path.exists(p)]
+            if missing:
+                raise RuntimeError(f"Stage '{stage.name}' did not create {', '.join(missing)}.")
+    except BaseException as e:
+        state.fail(stage, e)
+        raise
+    state.finish(stage)
+    if key is not None:
+        cache.store(key, stage.output_paths(), {"stage": stage.name, "params": _jsonable(stage.params)})
+    progress(f"Finish {stage.description} ({position})")
+
+
+def prunable_paths(stages: list[Stage], done: set, keep: list[str]):
+    """
+    return the intermediate paths, created by a finished stage, whose readers are all done and which are not in `keep`
+    """
+    created = {p for stage in stages if stage.name in done for p in stage.output_paths()}
+    readers = {}
+    for stage in stages:
+        for path in stage.input_paths():
+            readers.setdefault(path, set()).add(stage.name)
+    return [p for p in created if p in readers and readers[p] <= done and p not in keep]
+
+
+def _prune_read(state: RunState, stages: list[Stage], done: set, keep: list | Callable):
+    try:
+        paths = prunable_paths(stages, done, keep() if callable(keep) else keep)
+    except OSError:
+        # some paths are only known once an earlier stage is done (e.g. the reads layout), so nothing is pruned yet
+        return
+    for path in paths:
+        if os.path.exists(path):
+            state.prune(path)
+
+
+def run_stages(state: RunState, stages: list[Stage], resume: bool = True, force_from: str | None = None,
+               cache: ArtifactCache | None = None, jobs: int | None = None,
+               storage: StoragePolicy | None = None, keep: list | Callable | None = None,
+               until: str | None = None):
+    """
+    run every stage once the stages it depends on are done, up to `jobs` stages at once (default is no limit),
+    so independent branches run concurrently.
+    with `resume`, a stage whose outputs are present and whose inputs did not change is skipped.
+    `force_from` names a stage which is rerun together with every stage depending on it.
+    `until` names the last stage to run: only it and the stages it depends on are run.
+    with a `cache`, cacheable stages reuse the outputs of an earlier run with the same parameters and inputs.
+    if a stage fails, the stages already running are finished, no other stage is started and the error is raised.
+    with a `storage` policy which prunes, every intermediate not in `keep` (a list of paths, or a callable returning it)
+    is deleted once all the stages reading it are done.
+    """
+    storage = storage or StoragePolicy()
+    dependencies = stage_dependencies(stages)
+    if force_from is not None and force_from not in dependencies:
+        raise ValueError(f"force_from must be one of {', '.join(dependencies)}. Got '{force_from}'.")
+    forced = _dependents(dependencies, force_from) if force_from is not None else set()
+    if until is not None and until not in dependencies:
+        raise ValueError(f"until must be one of {', '.join(dependencies)}. Got '{until}'.")
+    scheduled = [stage for stage in stages if until is None or stage.name in _prerequisites(dependencies, until)]
+
+    positions = {stage.name: f"{i}/{len(stages)}" for i, stage in enumerate(stages, 1)}
+    pending, running, done, error = list(scheduled), {}, set(), None
+    with ContextThreadPoolExecutor(max_workers=max(1, jobs or len(scheduled))) as pool:
+        while pending or running:
+            if error is None:
+                for stage in [s for s in pending if done.issuperset(dependencies[s.name])]:
+                    pending.remove(stage)
+                    running[pool.submit(run_stage, state, stage, positions[stage.name], resume=resume,
+                                        forced=stage.name in forced, cache=cache,
+                                        min_free_gb=storage.min_free_gb)] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    error = error or e
+                else:
+                    done.add(stage.name)
+                    if storage.prune:
+                        _prune_read(state, stages, done, keep or [])
+    if error is not None:
+        raise error
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import errno
+import gzip
+import os
+import shutil
+from dataclasses import dataclass
+
+from .utilities import run_cmd
+
+
+@dataclass(frozen=True)
+class StoragePolicy:
+    """
+    what a run does to save disk space:
+     - `delete_sra`: delete the .sra of an accession as soon as it is converted to fastq.
+     - `compress_fastq`: gzip the fastq files of an accession as soon as they are written (with pigz if installed).
+     - `prune`: delete an intermediate file once every stage reading it is done.
+       final artifacts (e.g. the demux artifact, the final table and taxonomy) are always kept.
+     - `min_free_gb`: the free space required in the run directory before a stage starts.
+    """
+    delete_sra: bool = False
+    compress_fastq: bool = False
+    prune: bool = False
+    min_free_gb: float = 0
+
+
+def storage_policy(storage: StoragePolicy | dict | None):
+    if storage is None:
+        return StoragePolicy()
+    return storage if isinstance(storage, StoragePolicy) else StoragePolicy(**storage)
+
+
+def check_free_space(path: str, min_free_gb: float, stage_name: str = ""):
+    """
+    raise OSError(ENOSPC) if the file system of `path` has less than `min_free_gb` free
+    """
+    free = shutil.disk_usage(path).free
+    if free < min_free_gb * 2 ** 30:
+        raise OSError(errno.ENOSPC, f"Only {free / 2 ** 30:.1f}GB are free in {path}, "
+                                    f"but {min_free_gb}GB are required to start {stage_name or 'the stage'}.")
+
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def gzip_files(paths: list[str], threads: int = 1):
+    """
+    replace every file by its .gz, with pigz running `threads` threads, or with gzip of the standard library
+    """
+    if not paths:
+        return
+    if shutil.which("pigz") is not None:
+        run_cmd(["pigz", "--processes", str(threads)] + paths, check=True)
+        return
+    for path in paths:
+        with open(path, "rb") as f, gzip.open(path + ".gz.tmp", "wb", compresslevel=6) as out:
+            shutil.copyfileobj(f, out, 1 << 20)
+        os.replace(path + ".gz.tmp", path + ".gz")
+        os.remove(path)
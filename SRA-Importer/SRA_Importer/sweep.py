@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import csv
+import os
+import pickle
+from typing import Callable
+
+from .artifacts import read_tsv_rows
+from .backends import use_backend, CliBackend, ArtifactApiBackend
+from .cache import ArtifactCache
+from .export_data import trim_trunc_check, qiime_dada2
+from .instrumentation import ContextThreadPoolExecutor, RunRecorder
+from .stages import Stage, RunState, run_stages
+from .utilities import ReadsData, check_conda_qiime2
+
+
+def _as_label(value: int | tuple[int, int]):
+    return "-".join(map(str, value)) if isinstance(value, tuple) else str(value)
+
+
+def config_dir(sweep_path: str, trim: int | tuple[int, int], trunc: int | tuple[int, int]):
+    return os.path.join(sweep_path, f"trim-{_as_label(trim)}_trunc-{_as_label(trunc)}")
+
+
+def read_denoising_stats(stats_qza: str):
+    """
+    return the rows of the dada2 denoising stats as dicts of sample-id to the numeric columns
+    """
+    rows = read_tsv_rows(stats_qza, "stats.tsv")
+    return [{k: (v if k == "sample-id" else float(v)) for k, v in row.items()} for row in rows]
+
+
+def summarize_config(trim: int | tuple[int, int], trunc: int | tuple[int, int], stats: list[dict]):
+    total_input = sum(row["input"] for row in stats)
+    total_retained = sum(row["non-chimeric"] for row in stats)
+    retained = [row["non-chimeric"] / row["input"] for row in stats if row["input"]]
+    return {
+        "trim": _as_label(trim),
+        "trunc": _as_label(trunc),
+        "samples": len(stats),
+        "input": int(total_input),
+        "non-chimeric": int(total_retained),
+        "percentage retained": round(100 * total_retained / total_input, 2) if total_input else 0.0,
+        "min sample percentage retained": round(100 * min(retained), 2) if retained else 0.0,
+        "samples with no reads retained": sum(1 for row in stats if row["non-chimeric"] == 0),
+    }
+
+
+def write_tsv(path: str, rows: list[dict]):
+    with open(path, "w", newline="") as f:
+        if not rows:
+            return
+        tsv_writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()), delimiter="\t")
+        tsv_writer.writeheader()
+        tsv_writer.writerows(rows)
+
+
+def export_sweep(*, output_dir: str, grid: list[tuple], threads: int = 12, jobs: int | None = None,
+                 resume: bool = True, cache_dir: str | None = None, cache_max_gb: float = 50,
+                 callback: Callable[[dict], None] | None = None,
+                 backend: str | CliBackend | ArtifactApiBackend = "cli"):
+    """
+    run dada2 once for every (trim, trunc) pair of `grid`, each in its own directory under <output_dir>/sweep.
+    up to `jobs` runs (default is as many as fit in `threads`) share the `threads` budget.
+    return a row per configuration comparing the reads retained, which is also saved to sweep/summary.tsv
+    next to the per-sample sweep/comparison.tsv.
+    with backend="api", the runs share `jobs` qiime2 workers which keep the demultiplexed reads loaded.
+    """
+    check_conda_qiime2()
+
+    reads_data: ReadsData = pickle.load(open(os.path.join(output_dir, "reads_data.pkl"), "rb"))
+    for trim, trunc in grid:
+        trim_trunc_check(reads_data, trim, trunc)
+
+    paired = reads_data.rev and reads_data.fwd
+    demux_path = os.path.join(reads_data.dir_path, "qza", f"demux-{'paired' if paired else 'single'}-end.qza")
+    sweep_path = os.path.join(reads_data.dir_path, "sweep")
+    os.makedirs(sweep_path, exist_ok=True)
+
+    jobs = max(1, min(jobs or len(grid), len(grid), threads))
+    threads_per_run = max(1, threads // jobs)
+    cache = ArtifactCache(cache_dir, max_size=int(cache_max_gb * 2 ** 30)) if cache_dir is not None else None
+
+    def run_config(trim: int | tuple[int, int], trunc: int | tuple[int, int]):
+        path = config_dir(sweep_path, trim, trunc)
+        os.makedirs(path, exist_ok=True)
+        stage = Stage("qiime_dada2", description=f"dada2 trim={_as_label(trim)} trunc={_as_label(trunc)}",
+                      cacheable=True,
+                      func=lambda: qiime_dada2(reads_data, demux_path, left=trim, right=trunc,
+                                               threads=threads_per_run, output_path=path),
+                      inputs=[demux_path], params={"trim": trim, "trunc": trunc},
+                      outputs=[os.path.join(path, "dada2_table.qza"), os.path.join(path, "dada2_rep-seqs.qza"),
+                               os.path.join(path, "dada2_denoising-stats.qza")])
+        run_stages(RunState(path), [stage], resume=resume, cache=cache)
+        return read_denoising_stats(os.path.join(path, "dada2_denoising-stats.qza"))
+
+    with RunRecorder(os.path.join(sweep_path, "run_log.jsonl"), callback).activate(), \
+            use_backend(backend, workers=jobs), ContextThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_config, trim, trunc) for trim, trunc in grid]
+        results = [future.result() for future in futures]
+
+    summary, comparison = [], []
+    for (trim, trunc), stats in zip(grid, results):
+        summary.append(summarize_config(trim, trunc, stats))
+        comparison += [{"trim": _as_label(trim), "trunc": _as_label(trunc), **row} for row in stats]
+    write_tsv(os.path.join(sweep_path, "summary.tsv"), summary)
+    write_tsv(os.path.join(sweep_path, "comparison.tsv"), comparison)
+    return summary
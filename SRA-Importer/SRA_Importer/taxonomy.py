@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import csv
+import datetime
+import hashlib
+import io
+import math
+import os
+import shutil
+import sqlite3
+import threading
+import zipfile
+from concurrent.futures import as_completed
+from contextlib import closing
+
+from .artifacts import artifact_uuid, data_size, open_member, read_sequences
+from .backends import run_qiime, import_data
+from .instrumentation import ContextThreadPoolExecutor
+
+DEFAULT_TAXONOMY_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "SRA-Importer", "taxonomy.sqlite")
+# a loaded sklearn classifier takes about twice the uncompressed size of its artifact
+CLASSIFIER_MEMORY_FACTOR = 2
+SQLITE_VARIABLES = 500
+
+
+def sequence_hash(sequence: str):
+    # the same hash qiime2 uses for feature ids, so ids and hashes agree for dada2 features
+    return hashlib.md5(sequence.upper().encode()).hexdigest()
+
+
+def classifier_digest(classifier_path: str):
+    """
+    the uuid of a classifier artifact, or the content hash of any other file
+    """
+    try:
+        return artifact_uuid(classifier_path)
+    except zipfile.BadZipFile:
+        h = hashlib.blake2b(digest_size=20)
+        with open(classifier_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+class TaxonomyCache:
+    """
+    SQLite store of the taxonomy assigned to every sequence, keyed by the sequence hash and the classifier digest,
+    so a sequence already classified by the same classifier in any run is not classified again
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = os.path.abspath(path or DEFAULT_TAXONOMY_CACHE)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS taxonomy (classifier TEXT, sequence_hash TEXT, "
+                         "taxon TEXT, confidence TEXT, PRIMARY KEY (classifier, sequence_hash))")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=60, isolation_level=None))
+
+    def lookup(self, classifier: str, hashes: list[str]):
+        """
+        return a dict of sequence hash to (taxon, confidence) for the hashes found in the cache
+        """
+        found = {}
+        with self._connect() as conn:
+            for i in range(0, len(hashes), SQLITE_VARIABLES):
+                chunk = hashes[i:i + SQLITE_VARIABLES]
+                rows = conn.execute("SELECT sequence_hash, taxon, confidence FROM taxonomy WHERE classifier = ? "
+                                    f"AND sequence_hash IN ({','.join('?' * len(chunk))})", [classifier] + chunk)
+                found.update((h, (taxon, confidence)) for h, taxon, confidence in rows)
+        return found
+
+    def store(self, classifier: str, assignments: dict):
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO taxonomy VALUES (?, ?, ?, ?)",
+                             [(classifier, h, taxon, confidence) for h, (taxon, confidence) in assignments.items()])
+            conn.execute("COMMIT")
+
+
+def read_assignments(taxonomy_qza: str):
+    """
+    return a dict of feature id to (taxon, confidence) of a FeatureData[Taxonomy] artifact
+    """
+    with open_member(taxonomy_qza, "taxonomy.tsv") as member:
+        rows = csv.reader(io.TextIOWrapper(member, encoding="utf-8"), delimiter="\t")
+        return {row[0]: (row[1], row[2] if len(row) > 2 else "")
+                for row in rows if row and row[0] not in {"Feature ID", "#q2:types"}}
+
+
+def concurrent_batches(classifier_path: str, jobs: int, memory_gb: float | None = None):
+    """
+    number of batches classified at once: `jobs`, but no more classifiers than fit in `memory_gb`
+    """
+    if memory_gb is None:
+        return max(1, jobs)
+    try:
+        per_batch = CLASSIFIER_MEMORY_FACTOR * data_size(classifier_path)
+    except zipfile.BadZipFile:
+        per_batch = CLASSIFIER_MEMORY_FACTOR * os.path.getsize(classifier_path)
+    return max(1, min(jobs, int(memory_gb * 2 ** 30 // max(per_batch, 1))))
+
+
+def split_batches(hashes: list[str], batch_size: int, concurrent: int):
+    # at least one batch per concurrent classifier, as long as there are enough sequences
+    count = max(math.ceil(len(hashes) / batch_size), min(concurrent, len(hashes)))
+    size = math.ceil(len(hashes) / count) if count else 0
+    return [hashes[i:i + size] for i in range(0, len(hashes), size)] if size else []
+
+
+def classify_batch(batch_dir: str, index: int, sequences: dict, classifier_path: str,
+                   reads_per_batch: int | str = "auto"):
+    """
+    classify the sequences of a single batch (a dict of sequence hash to sequence), and return their assignments
+    """
+    fasta_path = os.path.join(batch_dir, f"batch-{index}.fasta")
+    with open(fasta_path, "w") as f:
+        for h, sequence in sequences.items():
+            f.write(f">{h}\n{sequence}\n")
+    reads_path = os.path.join(batch_dir, f"batch-{index}.qza")
+    taxonomy_path = os.path.join(batch_dir, f"batch-{index}-taxonomy.qza")
+    import_data("FeatureData[Sequence]", fasta_path, "DNAFASTAFormat", reads_path)
+    run_qiime("feature-classifier", "classify-sklearn",
+              inputs={"reads": reads_path, "classifier": os.path.abspath(classifier_path)},
+              params={"n_jobs": 1, "reads_per_batch": reads_per_batch},
+              outputs={"classification": taxonomy_path})
+    return read_assignments(taxonomy_path)
+
+
+def write_taxonomy_tsv(path: str, assignments: dict):
+    with open(path, "w", newline="") as f:
+        tsv_writer = csv.writer(f, delimiter="\t")
+        tsv_writer.writerow(["Feature ID", "Taxon", "Confidence"])
+        for feature_id, (taxon, confidence) in assignments.items():
+            tsv_writer.writerow([feature_id, taxon, confidence])
+
+
+def classify_taxonomy(rep_seqs_path: str, classifier_path: str, output_path: str, jobs: int = 1,
+                      batch_size: int = 20_000, memory_gb: float | None = None, reads_per_batch: int | str = "auto",
+                      cache: TaxonomyCache | None = None):
+    """
+    assign taxonomy to the sequences of `rep_seqs_path` and save it as a FeatureData[Taxonomy] artifact to `output_path`.
+    with no cache and a single batch, classify-sklearn runs on `rep_seqs_path` itself.
+    otherwise the sequences missing from `cache` are deduplicated, split into batches of up to `batch_size` sequences
+    and classified `jobs` batches at a time, within `memory_gb` of loaded classifiers.
+    new assignments are added to `cache`.
+    """
+    sequences = read_sequences(rep_seqs_path)
+    concurrent = concurrent_batches(classifier_path, jobs, memory_gb)
+    if cache is None and concurrent == 1 and len(sequences) <= batch_size:
+        # nothing to look up or split: the representative sequences are classified as they are,
+        # which keeps the classify-sklearn provenance of the taxonomy artifact
+        print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Classifying {len(sequences)} sequences")
+        run_qiime("feature-classifier", "classify-sklearn",
+                  inputs={"reads": rep_seqs_path, "classifier": os.path.abspath(classifier_path)},
+                  params={"n_jobs": 1, "reads_per_batch": reads_per_batch},
+                  outputs={"classification": output_path})
+        return
+
+    hashes = {feature_id: sequence_hash(sequence) for feature_id, sequence in sequences.items()}
+    unique = {h: sequences[feature_id] for feature_id, h in hashes.items()}
+    classifier = classifier_digest(classifier_path)
+    known = cache.lookup(classifier, list(unique)) if cache is not None else {}
+    missing = [h for h in unique if h not in known]
+    print(f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')} -- Classifying {len(missing)} sequences, "
+          f"{len(unique) - len(missing)} found in the taxonomy cache")
+
+    batch_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), "taxonomy-batches")
+    os.makedirs(batch_dir, exist_ok=True)
+    try:
+        with ContextThreadPoolExecutor(max_workers=concurrent) as pool:
+            futures = [pool.submit(classify_batch, batch_dir, i, {h: unique[h] for h in batch},
+                                   classifier_path, reads_per_batch)
+                       for i, batch in enumerate(split_batches(missing, batch_size, concurrent))]
+            for future in as_completed(futures):
+                assignments = future.result()
+                known.update(assignments)
+                if cache is not None:
+                    cache.store(classifier, assignments)
+
+        tsv_path = os.path.join(batch_dir, "taxonomy.tsv")
+        write_taxonomy_tsv(tsv_path, {feature_id: known[h] for feature_id, h in hashes.items()})
+        import_data("FeatureData[Taxonomy]", tsv_path, "TSVTaxonomyFormat", output_path)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
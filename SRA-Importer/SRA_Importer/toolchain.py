@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .utilities import run_cmd
+
+DEFAULT_TOOLCHAIN_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "SRA-Importer", "toolchain.json")
+TOOLS = ("qiime", "prefetch", "fasterq-dump", "biom")
+# probes of other environments kept in the cache file, so switching between environments does not probe again
+CACHED_ENVIRONMENTS = 16
+VERSION_PATTERN = re.compile(r"\d+(?:\.\d+)+")
+RELEASE_PATTERN = re.compile(r"(\d{4}\.\d{1,2})")
+
+_lock = threading.Lock()
+_probed = {}
+
+
+def toolchain_key():
+    """
+    the invalidation key of a probe: the conda environment and the path and mtime of every tool on PATH.
+    it costs a stat of every PATH directory and no subprocess.
+    """
+    tools = {}
+    for tool in TOOLS:
+        path = shutil.which(tool)
+        tools[tool] = [os.path.realpath(path), os.stat(path).st_mtime_ns] if path is not None else None
+    return {"conda_prefix": os.environ.get("CONDA_PREFIX"), "tools": tools}
+
+
+def _version(path: str):
+    try:
+        o, e = run_cmd([path, "--version"])
+    except OSError:
+        return None
+    match = VERSION_PATTERN.search(o + e)
+    return match.group(0) if match else None
+
+
+def qiime2_release(conda_prefix: str | None, qiime_version: str | None = None):
+    """
+    the qiime2 release (e.g. '2022.8') from the name of its conda environment, or from the version of q2cli
+    """
+    match = RELEASE_PATTERN.search(os.path.basename(conda_prefix or ""))
+    if match is not None:
+        return match.group(1)
+    return ".".join(qiime_version.split(".")[:2]) if qiime_version else None
+
+
+def _probe(key: dict):
+    tools = {tool: entry[0] for tool, entry in key["tools"].items() if entry is not None}
+    # 'qiime --version' alone takes seconds, so the tools are versioned together
+    with ThreadPoolExecutor(max_workers=len(tools) or 1) as pool:
+        versions = dict(zip(tools, pool.map(_version, tools.values())))
+    return {"conda_prefix": key["conda_prefix"],
+            "qiime2_release": qiime2_release(key["conda_prefix"], versions.get("qiime")),
+            "tools": {tool: {"path": tools.get(tool), "version": versions.get(tool)} for tool in TOOLS}}
+
+
+def _read_cache(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(path: str, entries: dict):
+    # written to a temp file and renamed, so concurrent processes never read half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entries, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def probe_toolchain(cache_file: str | None = None, refresh: bool = False):
+    """
+    return the path and version of qiime, prefetch, fasterq-dump and biom, and the qiime2 release.
+    the probe runs the tools once and is cached in memory and in `cache_file`, keyed by the conda environment
+    and the mtime of every tool, so it is probed again only when the environment or a tool changes.
+    """
+    cache_file = os.path.abspath(cache_file or DEFAULT_TOOLCHAIN_CACHE)
+    key = toolchain_key()
+    digest = hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+    with _lock:
+        if not refresh and digest in _probed:
+            return _probed[digest]
+        entries = _read_cache(cache_file)
+        probe = None if refresh else entries.get(digest)
+        if probe is None:
+            probe = _probe(key)
+            entries.pop(digest, None)
+            entries[digest] = probe
+            try:
+                _write_cache(cache_file, dict(list(entries.items())[-CACHED_ENVIRONMENTS:]))
+            except OSError as e:
+                print(f"WARNING: Could not save the toolchain cache to {cache_file}: {e}")
+        _probed[digest] = probe
+        return probe
+
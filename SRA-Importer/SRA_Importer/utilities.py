@@ -1,7 +1,12 @@
+import datetime
 import os
 import subprocess
+import threading
+import time
 from dataclasses import dataclass
 
+from .instrumentation import record_command
+
 
 @dataclass(frozen=True)
 class ReadsData:
@@ -10,24 +15,82 @@ class ReadsData:
     rev: bool = False
 
 
-def run_cmd(command: list):
+def make_run_dir(parent: str = ".", prefix: str = "SRA-Importer"):
+    """
+    create a new <prefix>-<creation_time> directory and return its absolute path.
+    the name has microseconds and the process id, and the directory is created exclusively,
+    so concurrent runs never share a directory.
+    """
+    while True:
+        start_import = datetime.datetime.now().strftime('%d-%m-%Y_%H-%M-%S-%f')
+        dir_path = os.path.join(os.path.abspath(parent), f"{prefix}-{start_import}-{os.getpid()}")
+        try:
+            os.makedirs(dir_path)
+            return dir_path
+        except FileExistsError:
+            continue
+
+
+class CommandError(Exception):
+    """
+    raised by run_cmd(check=True) when a command exits with a non-zero status
+    """
+    def __init__(self, command: list, returncode: int, stderr: str):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(f"Command '{' '.join(command)}' exited with status {returncode}.\n{stderr.strip()}")
+
+
+def _exit_code(status: int):
+    return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+def _communicate(proc: subprocess.Popen):
+    """
+    like proc.communicate(), but reaps the process with wait4 to get its resource usage.
+    return stdout, stderr and the rusage (None where wait4 is not available)
+    """
+    if not hasattr(os, "wait4"):
+        o, e = proc.communicate()
+        return o, e, None
+
+    output = {}
+    readers = [threading.Thread(target=lambda name, stream: output.__setitem__(name, stream.read()),
+                                args=(name, stream))
+               for name, stream in (("o", proc.stdout), ("e", proc.stderr))]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = _exit_code(status)
+    return output["o"], output["e"], rusage
+
+
+def run_cmd(command: list, check: bool = False):
+    start = time.perf_counter()
     proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    o, e = proc.communicate()
-    return o.decode("utf-8"), e.decode("utf-8")
+    o, e, rusage = _communicate(proc)
+    o, e = o.decode("utf-8"), e.decode("utf-8")
+    record_command(command, proc.returncode, time.perf_counter() - start, rusage, e)
+    if check and proc.returncode != 0:
+        raise CommandError(command, proc.returncode, e)
+    return o, e
 
 
 def qiime2_version():
-    o, e = run_cmd(["conda", "env", "list"])
-    qiime_version = ""
-    for env_1 in o.split("\n"):
-        for env_2 in env_1.split("/"):
-            if "qiime2" in env_2 and " " not in env_2:
-                qiime_version = env_2
-    return qiime_version
+    """
+    the qiime2 release of the active environment (e.g. '2022.8'), from the cached toolchain probe
+    """
+    from .toolchain import probe_toolchain
+    return probe_toolchain()["qiime2_release"] or ""
 
 
 def download_classifier_url():
-    return f"https://data.qiime2.org/{qiime2_version().split('-')[1]}/common/gg-13-8-99-nb-classifier.qza"
+    return f"https://data.qiime2.org/{qiime2_version()}/common/gg-13-8-99-nb-classifier.qza"
 
 
 def check_conda_qiime2():
@@ -0,0 +1,89 @@
+"""
+time the fastq catalog and the manifest of a run with tens of thousands of samples.
+the fastq files are empty, since only their names are read.
+
+python benchmarks/manifest_benchmark.py --samples 50000 --single-fraction 0.1
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SRA-Importer"))
+from SRA_Importer.catalog import scan_fastq, write_manifest  # noqa: E402
+from SRA_Importer.create_visualization import reads_layout, create_manifest  # noqa: E402
+
+
+def make_fastq_dir(fastq_dir: str, samples: int, single_fraction: float = 0, gz: bool = False, seed: int = 0):
+    """
+    create the empty fastq files of `samples` accessions, a `single_fraction` of them single-end
+    """
+    rng = random.Random(seed)
+    suffix = ".fastq.gz" if gz else ".fastq"
+    os.makedirs(fastq_dir, exist_ok=True)
+    files = 0
+    for i in range(1, samples + 1):
+        names = [f"SRR{i:08d}{suffix}"] if rng.random() < single_fraction else \
+            [f"SRR{i:08d}_1{suffix}", f"SRR{i:08d}_2{suffix}"]
+        for name in names:
+            open(os.path.join(fastq_dir, name), "w").close()
+        files += len(names)
+    return files
+
+
+def legacy_listing(fastq_dir: str):
+    # the directory work of the former create_manifest: three listings and an isfile() of every entry in each
+    for _ in range(3):
+        [f for f in os.listdir(fastq_dir) if os.path.isfile(os.path.join(fastq_dir, f))]
+
+
+def timed(func, repeat: int):
+    # the warnings about mixed layouts are left out of the output
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the fastq catalog and the manifest")
+    parser.add_argument("--samples", type=int, default=50_000)
+    parser.add_argument("--single-fraction", type=float, default=0, help="the fraction of single-end samples")
+    parser.add_argument("--gz", action="store_true", help="name the files .fastq.gz")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every step, the fastest is reported")
+    parser.add_argument("--work-dir", help="create the files in this directory instead of a removed temp directory")
+    args = parser.parse_args()
+
+    dir_path = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="SRA-Importer-manifest-")
+    try:
+        fastq_dir = os.path.join(dir_path, "fastq")
+        files = make_fastq_dir(fastq_dir, args.samples, args.single_fraction, args.gz)
+        manifest_path = os.path.join(dir_path, "manifest.tsv")
+        steps = [
+            ("legacy listing", lambda: legacy_listing(fastq_dir)),
+            ("scan_fastq", lambda: scan_fastq(fastq_dir)),
+            ("write_manifest", lambda: write_manifest(manifest_path, samples)),
+            ("reads_layout", lambda: reads_layout(dir_path)),
+            ("create_manifest", lambda: create_manifest(layout)),
+        ]
+        samples, layout = scan_fastq(fastq_dir), reads_layout(dir_path)
+        print(f"{args.samples} samples, {files} files, paired: {layout.rev}")
+        for name, func in steps:
+            print(f"{name:<18}{timed(func, args.repeat) * 1000:>10.1f} ms")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
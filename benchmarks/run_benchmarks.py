@@ -0,0 +1,183 @@
+"""
+time visualization() and export() end to end and per stage, on synthetic samples and with stub executables
+standing in for prefetch, fasterq-dump, qiime, biom and conda (see stubs/).
+
+every sample count gets a fresh run directory, so no stage is skipped by resuming. the stage times come from the
+run log events, and a TSV with a row per stage (and a 'total' row per call) is written to --output.
+
+python benchmarks/run_benchmarks.py --samples 4 16 64 --reads 2000 --jobs 4 \
+    --times '{"default": 0.05, "qiime dada2": 2}' --export-kwargs '{"taxonomy_jobs": 4}'
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+STUBS_DIR = os.path.join(BENCHMARKS_DIR, "stubs")
+sys.path.insert(0, STUBS_DIR)
+from _stub import write_artifact  # noqa: E402  (also puts the repo's package on sys.path)
+
+TOOLS = {"prefetch": "prefetch.py", "fasterq-dump": "fasterq_dump.py", "qiime": "qiime.py", "biom": "biom.py",
+         "conda": "conda.py"}
+COLUMNS = ["samples", "repeat", "call", "stage", "status", "wall_time", "cpu_time", "peak_rss_kb", "bytes_written",
+           "commands"]
+
+
+def install_stubs(work_dir: str):
+    """
+    put a wrapper of every stub on PATH and activate a fake qiime2 conda environment
+    """
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool, script in TOOLS.items():
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.join(STUBS_DIR, script)}\" \"$@\"\n")
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["CONDA_PREFIX"] = os.path.join(work_dir, "envs", "qiime2-2022.8")
+    os.environ["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p)
+
+
+def fake_classifier(work_dir: str):
+    path = os.path.join(work_dir, "classifier.qza")
+    write_artifact(path, "TaxonomicClassifier", {"sklearn_pipeline.tar": os.urandom(1 << 16)})
+    return path
+
+
+def _trim_trunc(value: str):
+    value = json.loads(value) if value != "auto" else value
+    return tuple(value) if isinstance(value, list) else value
+
+
+def run_once(run_dir: str, samples: int, args, classifier_path: str):
+    """
+    run visualization() and export() on `samples` accessions, and return the rows of their stages and totals
+    """
+    from SRA_Importer import visualization, export
+
+    os.makedirs(run_dir)
+    acc_list = os.path.join(run_dir, "acc_list.txt")
+    with open(acc_list, "w") as f:
+        f.write("".join(f"SRR{i:07d}\n" for i in range(1, samples + 1)))
+
+    events = []
+    calls = [
+        ("visualization", lambda: visualization(acc_list=acc_list, output_vis_path="", output_dir=run_dir,
+                                                jobs=args.jobs, callback=events.append,
+                                                **json.loads(args.visualization_kwargs))),
+        ("export", lambda: export(output_dir=run_dir, trim=_trim_trunc(args.trim), trunc=_trim_trunc(args.trunc),
+                                  classifier_file=classifier_path,
+                                  otu_output_file=os.path.join(run_dir, "otu.tsv"),
+                                  taxonomy_output_file=os.path.join(run_dir, "taxonomy.tsv"),
+                                  threads=args.threads, callback=events.append,
+                                  **{"amplicon_length": args.amplicon_length, **json.loads(args.export_kwargs)})),
+    ]
+    rows = []
+    log = open(os.path.join(run_dir, "benchmark.log"), "w")
+    try:
+        for call, func in calls:
+            del events[:]
+            status, start = "done", time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else log), \
+                        contextlib.redirect_stderr(sys.stderr if args.verbose else log):
+                    func()
+            except Exception as e:
+                status = f"failed: {e}"
+            wall_time = time.perf_counter() - start
+            for event in events:
+                if event["event"] == "stage" and "wall_time" in event:
+                    rows.append({"samples": samples, "call": call, "stage": event["stage"],
+                                 "status": event["status"], "wall_time": event["wall_time"],
+                                 "cpu_time": event["cpu_time"], "peak_rss_kb": event["peak_rss_kb"],
+                                 "bytes_written": event["bytes_written"], "commands": len(event["commands"])})
+            rows.append({"samples": samples, "call": call, "stage": "total", "status": status,
+                         "wall_time": round(wall_time, 3),
+                         "cpu_time": round(sum(r["cpu_time"] for r in rows if r["call"] == call), 3)})
+            if status != "done":
+                break
+    finally:
+        log.close()
+    return rows
+
+
+def summarize(rows: list[dict]):
+    """
+    print the median wall time of every stage by the number of samples
+    """
+    counts = sorted({r["samples"] for r in rows})
+    stages = list(dict.fromkeys((r["call"], r["stage"]) for r in rows))
+    print(f"{'call':<14}{'stage':<28}" + "".join(f"{f'{n} samples':>14}" for n in counts))
+    for call, stage in stages:
+        times = [[r["wall_time"] for r in rows if (r["call"], r["stage"], r["samples"]) == (call, stage, n)]
+                 for n in counts]
+        print(f"{call:<14}{stage:<28}" + "".join(f"{statistics.median(t):>13.2f}s" if t else f"{'-':>14}"
+                                                 for t in times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark visualization() and export() with stub executables")
+    parser.add_argument("--samples", type=int, nargs="+", default=[2, 8, 32], help="the sample counts to run")
+    parser.add_argument("--reads", type=int, default=1000, help="reads per sample")
+    parser.add_argument("--read-length", type=int, default=150)
+    parser.add_argument("--single", action="store_true", help="single-end instead of paired-end reads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="'jobs' of visualization()")
+    parser.add_argument("--threads", type=int, default=1, help="'threads' of export()")
+    parser.add_argument("--trim", default="auto", help="'trim' of export(), as JSON or 'auto'")
+    parser.add_argument("--trunc", default="auto", help="'trunc' of export(), as JSON or 'auto'")
+    parser.add_argument("--amplicon-length", type=int, default=253,
+                        help="'amplicon_length' of export(), needed by trunc 'auto' of paired reads")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every sample count")
+    parser.add_argument("--times", default='{"default": 0.05}',
+                        help="JSON of a stub command prefix (e.g. 'qiime dada2') to the seconds it sleeps")
+    parser.add_argument("--visualization-kwargs", default="{}", help="JSON of more arguments to visualization()")
+    parser.add_argument("--export-kwargs", default="{}", help="JSON of more arguments to export()")
+    parser.add_argument("--work-dir", help="keep the runs in this directory instead of a removed temp directory")
+    parser.add_argument("--output", default="benchmark.tsv", help="the TSV of the stage times")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the runs")
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="SRA-Importer-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    install_stubs(work_dir)
+    os.environ.update({"SRA_IMPORTER_STUB_TIMES": args.times,
+                       "SRA_IMPORTER_STUB_READS": str(args.reads),
+                       "SRA_IMPORTER_STUB_READ_LENGTH": str(args.read_length),
+                       "SRA_IMPORTER_STUB_PAIRED": "0" if args.single else "1",
+                       "SRA_IMPORTER_STUB_SEED": str(args.seed)})
+    classifier_path = fake_classifier(work_dir)
+
+    rows = []
+    try:
+        for samples in args.samples:
+            for repeat in range(1, args.repeat + 1):
+                run_dir = os.path.join(work_dir, f"{samples}-samples-{repeat}")
+                run_rows = run_once(run_dir, samples, args, classifier_path)
+                rows += [{**row, "repeat": repeat} for row in run_rows]
+                print(f"{samples} samples, run {repeat}: " + ", ".join(
+                    f"{r['call']} {r['wall_time']:.2f}s ({r['status']})" for r in run_rows if r["stage"] == "total"))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, COLUMNS, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(rows)
+    summarize(rows)
+    print(f"\nThe stage times are saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
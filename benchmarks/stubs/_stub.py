@@ -0,0 +1,73 @@
+"""
+shared helpers of the stub executables. a stub sleeps for the time configured for its command, may fail on request,
+and otherwise writes outputs in the same formats as the real tool.
+
+environment variables:
+ - SRA_IMPORTER_STUB_TIMES: JSON of command prefix (e.g. "qiime dada2") to seconds, with a "default" entry.
+ - SRA_IMPORTER_STUB_FAIL: a command prefix or an accession whose commands exit with an error.
+ - SRA_IMPORTER_STUB_READS, SRA_IMPORTER_STUB_READ_LENGTH, SRA_IMPORTER_STUB_PAIRED, SRA_IMPORTER_STUB_SEED:
+   the synthetic reads written by fasterq-dump.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+import uuid
+import zipfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BENCHMARKS_DIR, os.path.join(os.path.dirname(BENCHMARKS_DIR), "SRA-Importer")]
+
+DEFAULT_SECONDS = 0.05
+
+
+def start(tool: str, args: list[str]):
+    """
+    sleep for the configured time of the command, or exit with an error if it was asked to fail.
+    '--version' is answered at once, as the toolchain probe of the package runs it.
+    """
+    if args == ["--version"]:
+        print(f"{tool} : 0.0.0")
+        sys.exit(0)
+    command = " ".join([tool] + args)
+    fail = os.environ.get("SRA_IMPORTER_STUB_FAIL")
+    if fail and (command.startswith(fail) or fail in args):
+        sys.stderr.write(f"{tool}: stub failure of '{command}'\n")
+        sys.exit(3)
+    times = json.loads(os.environ.get("SRA_IMPORTER_STUB_TIMES", "{}"))
+    prefixes = [p for p in times if p != "default" and command.startswith(p)]
+    time.sleep(times[max(prefixes, key=len)] if prefixes else times.get("default", DEFAULT_SECONDS))
+
+
+def option(args: list[str], name: str, default: str | None = None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def reads_config():
+    return {"reads": int(os.environ.get("SRA_IMPORTER_STUB_READS", 1000)),
+            "read_length": int(os.environ.get("SRA_IMPORTER_STUB_READ_LENGTH", 150)),
+            "paired": os.environ.get("SRA_IMPORTER_STUB_PAIRED", "1") == "1",
+            "seed": int(os.environ.get("SRA_IMPORTER_STUB_SEED", 0))}
+
+
+def write_artifact(path: str, semantic_type: str, files: dict):
+    """
+    write a .qza/.qzv archive laid out like qiime2's: <uuid>/metadata.yaml and <uuid>/data/<files>
+    """
+    artifact_uuid = uuid.uuid4()
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(f"{artifact_uuid}/VERSION", "QIIME 2\narchive: 5\nframework: 2022.8.0\n")
+        archive.writestr(f"{artifact_uuid}/metadata.yaml",
+                         f"uuid: {artifact_uuid}\ntype: {semantic_type}\nformat: null\n")
+        for name, content in files.items():
+            archive.writestr(f"{artifact_uuid}/data/{name}", content)
+
+
+def read_members(path: str):
+    """
+    return a dict of the data file names of an artifact to their content
+    """
+    with zipfile.ZipFile(path) as archive:
+        return {name.split("/data/", 1)[1]: archive.read(name) for name in archive.namelist() if "/data/" in name}
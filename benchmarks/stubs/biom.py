@@ -0,0 +1,16 @@
+"""
+stub of 'biom convert -i TABLE.biom -o TABLE.tsv --to-tsv'
+"""
+import sys
+
+from _stub import start, option
+from SRA_Importer.artifacts import load_biom, write_table_tsv
+
+
+def main(args):
+    start("biom", args)
+    write_table_tsv(option(args, "-o"), *load_biom(option(args, "-i")))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
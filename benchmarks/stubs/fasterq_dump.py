@@ -0,0 +1,22 @@
+"""
+stub of 'fasterq-dump --split-files SRA -O DIR ...', which writes the synthetic reads described by the .sra file
+"""
+import json
+import os
+import sys
+
+from _stub import start, option
+from synthetic import write_sample
+
+
+def main(args):
+    start("fasterq-dump", args)
+    with open(option(args, "--split-files")) as f:
+        sra = json.load(f)
+    output_dir = option(args, "-O", ".")
+    os.makedirs(output_dir, exist_ok=True)
+    write_sample(output_dir, sra["accession"], sra["reads"], sra["read_length"], sra["paired"], sra["seed"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
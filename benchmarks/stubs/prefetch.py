@@ -0,0 +1,34 @@
+"""
+stub of 'prefetch ACC ... --output-directory DIR' and 'prefetch --option-file FILE --output-directory DIR'.
+every .sra file holds the description of the synthetic reads fasterq-dump writes for it.
+"""
+import json
+import os
+import sys
+
+from _stub import start, option, reads_config
+
+
+def main(args):
+    if "--option-file" in args:
+        with open(option(args, "--option-file")) as f:
+            accessions = [line.strip() for line in f if line.strip()]
+    else:
+        accessions = [args[0]]
+    output_dir = option(args, "--output-directory", ".")
+    failed = False
+    for acc in accessions:
+        # like prefetch, a failed accession does not stop the others
+        try:
+            start("prefetch", [acc])
+        except SystemExit:
+            failed = True
+            continue
+        os.makedirs(os.path.join(output_dir, acc), exist_ok=True)
+        with open(os.path.join(output_dir, acc, f"{acc}.sra"), "w") as f:
+            json.dump({"accession": acc, **reads_config()}, f)
+    sys.exit(3 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,216 @@
+"""
+stub of the 'qiime' commands SRA-Importer runs. the artifacts it writes hold the same data files as qiime2's,
+derived from the input reads, so every stage downstream reads real tables, sequences and taxonomies.
+"""
+from __future__ import annotations
+
+import csv
+import gzip
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from collections import Counter
+
+from _stub import start, option, write_artifact, read_members
+
+STATS_HEADER = ["sample-id", "input", "filtered", "percentage of input passed filter", "denoised", "non-chimeric",
+                "percentage of input non-chimeric"]
+TAXA = ["k__Bacteria; p__Firmicutes; c__Bacilli; o__Lactobacillales; f__Streptococcaceae; g__Streptococcus",
+        "k__Bacteria; p__Bacteroidetes; c__Bacteroidia; o__Bacteroidales; f__Bacteroidaceae; g__Bacteroides",
+        "k__Bacteria; p__Proteobacteria; c__Gammaproteobacteria; o__Enterobacteriales; f__Enterobacteriaceae",
+        "k__Bacteria; p__Actinobacteria; c__Actinobacteria; o__Bifidobacteriales; f__Bifidobacteriaceae",
+        "k__Bacteria; p__Proteobacteria; c__Alphaproteobacteria; o__Rickettsiales; f__mitochondria",
+        "k__Bacteria; p__Cyanobacteria; c__Chloroplast; o__Streptophyta"]
+
+
+def fastq_records(content: bytes):
+    lines = io.TextIOWrapper(io.BytesIO(content), encoding="ascii")
+    for header in lines:
+        sequence, _, quality = next(lines).strip(), next(lines), next(lines).strip()
+        yield header.strip(), sequence, quality
+
+
+def import_manifest(manifest_path: str):
+    """
+    the demux artifact of a fastq manifest: Casava named, gzipped fastq files and a MANIFEST
+    """
+    with open(manifest_path, newline="") as f:
+        rows = list(csv.DictReader(f, delimiter="\t"))
+    files, manifest = {}, ["sample-id,filename,direction"]
+    for i, row in enumerate(rows, 1):
+        paths = [row.get("forward-absolute-filepath") or row.get("absolute-filepath"),
+                 row.get("reverse-absolute-filepath")]
+        for read, path in enumerate(paths, 1):
+            if path is None:
+                continue
+            name = f"{row['SampleID']}_{i}_L001_R{read}_001.fastq.gz"
+            with open(path, "rb") as fastq:
+                content = fastq.read()
+            files[name] = content if path.endswith(".gz") else gzip.compress(content, compresslevel=1)
+            manifest.append(f"{row['SampleID']},{name},{'forward' if read == 1 else 'reverse'}")
+    files["MANIFEST"] = "\n".join(manifest) + "\n"
+    files["metadata.yml"] = "phred-offset: 33\n"
+    return files
+
+
+def demux_reads(demux_path: str):
+    """
+    return a dict of sample id to the forward reads of a demux artifact
+    """
+    reads = {}
+    for name, content in read_members(demux_path).items():
+        if name.endswith("_R1_001.fastq.gz"):
+            reads[name.rsplit("_", 4)[0]] = list(fastq_records(gzip.decompress(content)))
+    return reads
+
+
+def write_table(samples: dict):
+    """
+    a feature-table.biom of the counts of every feature (a dict of sample id to a Counter of sequences).
+    return it with the fasta of the features, whose ids are their md5 like the ids of dada2.
+    """
+    import numpy as np
+    from scipy import sparse
+    from SRA_Importer.merge import write_biom
+
+    sequences = sorted({s for counts in samples.values() for s in counts})
+    sample_ids = sorted(samples)
+    matrix = sparse.csr_matrix(np.array([[samples[sample].get(s, 0) for sample in sample_ids] for s in sequences],
+                                        dtype=float).reshape(len(sequences), len(sample_ids)))
+    ids = [hashlib.md5(s.encode()).hexdigest() for s in sequences]
+    with tempfile.TemporaryDirectory() as tmp:
+        write_biom(os.path.join(tmp, "feature-table.biom"), matrix, ids, sample_ids)
+        with open(os.path.join(tmp, "feature-table.biom"), "rb") as f:
+            biom = f.read()
+    return biom, "".join(f">{i}\n{s}\n" for i, s in zip(ids, sequences))
+
+
+def denoise(args: list[str], trim: int, trunc: int):
+    """
+    the features of the truncated reads seen at least twice. reads with a sequencing error rarely repeat,
+    so as with a real denoiser most features are the amplicons of the samples.
+    """
+    reads = demux_reads(option(args, "--i-demultiplexed-seqs"))
+    samples = {sample: Counter(s[trim:trunc or None] for _, s, _ in records) for sample, records in reads.items()}
+    total = Counter()
+    for counts in samples.values():
+        total.update(counts)
+    samples = {sample: Counter({s: n for s, n in counts.items() if total[s] > 1}) for sample, counts in samples.items()}
+    biom, fasta = write_table(samples)
+    stats = [STATS_HEADER, ["#q2:types"] + ["numeric"] * 6]
+    for sample, counts in samples.items():
+        kept = sum(counts.values())
+        percentage = f"{100 * kept / max(len(reads[sample]), 1):.2f}"
+        stats.append([sample, len(reads[sample]), len(reads[sample]), "100.00", kept, kept, percentage])
+    return biom, fasta, "".join("\t".join(map(str, row)) + "\n" for row in stats)
+
+
+def read_table(table_path: str):
+    from SRA_Importer.artifacts import read_feature_table
+    matrix, feature_ids, sample_ids = read_feature_table(table_path)
+    return matrix.tocsr(), feature_ids, sample_ids
+
+
+def filtered_table(table_path: str, keep):
+    """
+    the feature-table.biom of the features of a table for which keep(feature id, row) is true
+    """
+    from SRA_Importer.merge import write_biom
+    matrix, feature_ids, sample_ids = read_table(table_path)
+    rows = [i for i, feature_id in enumerate(feature_ids) if keep(feature_id, matrix.getrow(i))]
+    with tempfile.TemporaryDirectory() as tmp:
+        write_biom(os.path.join(tmp, "feature-table.biom"), matrix[rows], [feature_ids[i] for i in rows], sample_ids)
+        with open(os.path.join(tmp, "feature-table.biom"), "rb") as f:
+            return f.read()
+
+
+def classify(reads_path: str):
+    # every sequence gets a fixed taxon by its hash, some of them excluded by the default 'filter_taxa'
+    lines = ["Feature ID\tTaxon\tConfidence"]
+    fasta = read_members(reads_path)["dna-sequences.fasta"].decode().split()
+    for feature_id in (line[1:] for line in fasta if line.startswith(">")):
+        confidence = int(feature_id[8:12], 16) % 90 + 10
+        lines.append(f"{feature_id}\t{TAXA[int(feature_id[:8], 16) % len(TAXA)]}\t0.{confidence}")
+    return "\n".join(lines) + "\n"
+
+
+def main(args: list[str]):
+    start("qiime", args)
+    command = tuple(args[:2])
+    if command == ("tools", "export"):
+        output_path = option(args, "--output-path")
+        os.makedirs(output_path, exist_ok=True)
+        for name, content in read_members(option(args, "--input-path")).items():
+            with open(os.path.join(output_path, name), "wb") as f:
+                f.write(content)
+        return
+
+    if command == ("tools", "import"):
+        semantic_type, input_path = option(args, "--type"), option(args, "--input-path")
+        if semantic_type.startswith("SampleData"):
+            files = import_manifest(input_path)
+        else:
+            with open(input_path, "rb") as f:
+                name = "taxonomy.tsv" if semantic_type == "FeatureData[Taxonomy]" else "dna-sequences.fasta"
+                files = {name: f.read()}
+        write_artifact(option(args, "--output-path"), semantic_type, files)
+        return
+
+    if command == ("demux", "summarize"):
+        counts = {sample: len(records) for sample, records in demux_reads(option(args, "--i-data")).items()}
+        write_artifact(option(args, "--o-visualization"), "Visualization",
+                       {"index.html": "<html><body>Demultiplexed sequence counts summary</body></html>\n",
+                        "per-sample-fastq-counts.tsv": "sample ID\tforward sequence count\n" +
+                                                       "".join(f"{s}\t{n}\n" for s, n in counts.items())})
+    elif command[0] == "dada2":
+        suffix = "-f" if command[1] == "denoise-paired" else ""
+        biom, fasta, stats = denoise(args, int(option(args, f"--p-trim-left{suffix}", 0)),
+                                     int(option(args, f"--p-trunc-len{suffix}", 0)))
+        write_artifact(option(args, "--o-table"), "FeatureTable[Frequency]", {"feature-table.biom": biom})
+        write_artifact(option(args, "--o-representative-sequences"), "FeatureData[Sequence]",
+                       {"dna-sequences.fasta": fasta})
+        write_artifact(option(args, "--o-denoising-stats"), "SampleData[DADA2Stats]", {"stats.tsv": stats})
+    elif command == ("deblur", "denoise-16S"):
+        biom, fasta, stats = denoise(args, 0, int(option(args, "--p-trim-length", 0)))
+        write_artifact(option(args, "--o-table"), "FeatureTable[Frequency]", {"feature-table.biom": biom})
+        write_artifact(option(args, "--o-representative-sequences"), "FeatureData[Sequence]",
+                       {"dna-sequences.fasta": fasta})
+        write_artifact(option(args, "--o-stats"), "DeblurStats", {"stats.csv": stats.replace("\t", ",")})
+    elif command in {("vsearch", "join-pairs"), ("quality-filter", "q-score")}:
+        # joining and filtering keep the forward reads as they are
+        demux = read_members(option(args, "--i-demultiplexed-seqs") or option(args, "--i-demux"))
+        demux = {name: content for name, content in demux.items() if "_R2_" not in name}
+        if command[0] == "vsearch":
+            write_artifact(option(args, "--o-joined-sequences"), "SampleData[JoinedSequencesWithQuality]", demux)
+        else:
+            write_artifact(option(args, "--o-filtered-sequences"), "SampleData[SequencesWithQuality]", demux)
+            write_artifact(option(args, "--o-filter-stats"), "QualityFilterStats", {"stats.csv": "sample-id\n"})
+    elif command == ("vsearch", "cluster-features-de-novo"):
+        write_artifact(option(args, "--o-clustered-table"), "FeatureTable[Frequency]",
+                       {"feature-table.biom": read_members(option(args, "--i-table"))["feature-table.biom"]})
+        write_artifact(option(args, "--o-clustered-sequences"), "FeatureData[Sequence]",
+                       {"dna-sequences.fasta": read_members(option(args, "--i-sequences"))["dna-sequences.fasta"]})
+    elif command == ("feature-classifier", "classify-sklearn"):
+        write_artifact(option(args, "--o-classification"), "FeatureData[Taxonomy]",
+                       {"taxonomy.tsv": classify(option(args, "--i-reads"))})
+    elif command == ("taxa", "filter-table"):
+        from SRA_Importer.artifacts import read_taxonomy
+        taxonomy = read_taxonomy(option(args, "--i-taxonomy"))["Taxon"].to_dict()
+        exclude = [term.lower() for term in option(args, "--p-exclude", "").split(",") if term]
+        excluded = lambda feature_id: any(term in taxonomy.get(feature_id, "").lower() for term in exclude)
+        biom = filtered_table(option(args, "--i-table"), lambda feature_id, row: not excluded(feature_id))
+        write_artifact(option(args, "--o-filtered-table"), "FeatureTable[Frequency]", {"feature-table.biom": biom})
+    elif command == ("feature-table", "filter-features"):
+        min_samples, min_frequency = int(option(args, "--p-min-samples", 0)), int(option(args, "--p-min-frequency", 0))
+        biom = filtered_table(option(args, "--i-table"),
+                              lambda feature_id, row: row.nnz >= min_samples and row.sum() >= min_frequency)
+        write_artifact(option(args, "--o-filtered-table"), "FeatureTable[Frequency]", {"feature-table.biom": biom})
+    else:
+        sys.stderr.write(f"qiime: the stub does not implement '{' '.join(command)}'\n")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
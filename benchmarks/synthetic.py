@@ -0,0 +1,101 @@
+"""
+synthetic amplicon reads for the benchmarks.
+
+every sample draws its reads from a fixed pool of amplicons with a per-sample abundance, adds a few substitutions,
+and gives them qualities which decay along the read like those of an Illumina run.
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import os
+import random
+
+BASES = "ACGT"
+
+
+def amplicon_pool(size: int = 50, length: int = 300, seed: int = 0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(BASES) for _ in range(length)) for _ in range(size)]
+
+
+def _qualities(rng: random.Random, length: int):
+    # the mean Phred score drops from ~38 at the start of the read to ~20 at its end
+    scores = (max(2, min(41, int(rng.gauss(38 - 18 * (i / length) ** 2, 3)))) for i in range(length))
+    return "".join(chr(33 + q) for q in scores)
+
+
+def _with_errors(rng: random.Random, sequence: str, quality: str):
+    # bases with a low quality are substituted with the probability their score stands for
+    return "".join(rng.choice(BASES) if rng.random() < 10 ** (-(ord(q) - 33) / 10) else b
+                   for b, q in zip(sequence, quality))
+
+
+def _reverse_complement(sequence: str):
+    return sequence[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+
+def sample_reads(name: str, reads: int = 1000, read_length: int = 150, paired: bool = True, seed: int = 0,
+                 pool: list[str] | None = None):
+    """
+    yield (forward, reverse) records of a sample, each a (header, sequence, quality) tuple.
+    reverse is None for single-end reads.
+    """
+    pool = pool or amplicon_pool(seed=seed)
+    rng = random.Random(f"{seed}-{name}")
+    weights = [rng.paretovariate(1.2) for _ in pool]
+    for i, amplicon in enumerate(rng.choices(pool, weights=weights, k=reads), 1):
+        quality = _qualities(rng, read_length)
+        forward = (f"@{name}.{i} {i} length={read_length}", _with_errors(rng, amplicon[:read_length], quality),
+                   quality)
+        reverse = None
+        if paired:
+            quality = _qualities(rng, read_length)
+            reverse = (forward[0], _with_errors(rng, _reverse_complement(amplicon)[:read_length], quality), quality)
+        yield forward, reverse
+
+
+def _open(path: str):
+    return gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")
+
+
+def write_sample(output_dir: str, name: str, reads: int = 1000, read_length: int = 150, paired: bool = True,
+                 seed: int = 0, gz: bool = False, pool: list[str] | None = None):
+    """
+    write the reads of a sample the way 'fasterq-dump --split-files' does: <name>_1.fastq and <name>_2.fastq
+    for paired reads, <name>.fastq for single-end reads. return the written paths.
+    """
+    suffix = ".fastq.gz" if gz else ".fastq"
+    paths = [os.path.join(output_dir, f"{name}_1{suffix}"), os.path.join(output_dir, f"{name}_2{suffix}")] \
+        if paired else [os.path.join(output_dir, f"{name}{suffix}")]
+    files = [_open(path) for path in paths]
+    try:
+        for records in sample_reads(name, reads, read_length, paired, seed, pool):
+            for f, (header, sequence, quality) in zip(files, records):
+                f.write(f"{header}\n{sequence}\n+\n{quality}\n")
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write synthetic amplicon fastq files")
+    parser.add_argument("output_dir")
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--read-length", type=int, default=150)
+    parser.add_argument("--single", action="store_true", help="write single-end reads")
+    parser.add_argument("--gz", action="store_true", help="gzip the fastq files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    pool = amplicon_pool(seed=args.seed)
+    for i in range(1, args.samples + 1):
+        write_sample(args.output_dir, f"SRR{i:07d}", args.reads, args.read_length, not args.single, args.seed,
+                     args.gz, pool)
+
+
+if __name__ == "__main__":
+    main()
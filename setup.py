@@ -67,7 +67,7 @@ if __name__ == '__main__':
         license_files="LICENSE",
         install_requires=requirements,
         packages=find_packages('SRA-Importer'),
-        python_requires=">=3.6.8",
+        python_requires=">=3.7",
         include_package_data=True,
         has_ext_modules=lambda: True,
         package_dir={"": "SRA-Importer"},